@@ -1,68 +1,900 @@
 #!/bin/python
 
-SIZE = 16
+import argparse
+import bisect
+import csv
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import timeit
+from collections import OrderedDict
+
+DEFAULT_NUM_FRAMES = 16
+CHUNK_SIZE = 1 << 16
+# Binary traces are packed little-endian unsigned 32-bit page numbers
+BINARY_FORMAT = '<I'
+BINARY_ITEM_SIZE = struct.calcsize(BINARY_FORMAT)
+GOLDEN_DIR = os.path.dirname(os.path.abspath(__file__))
+# out2.txt was produced with four frames rather than the default
+GOLDEN_FRAMES = {'in2.txt': 4}
 
 def main():
-  rs = [int(p) for p in raw_input().split(' ')]
-  fifo(rs[:])
-  lru(rs[:])
-  second_chance(rs[:])
+  parser = argparse.ArgumentParser(description='Page replacement simulator')
+  parser.add_argument('trace', nargs='?',
+                      help='reference string file (default: stdin)')
+  parser.add_argument('-b', '--binary', action='store_true',
+                      help='trace is a packed binary file')
+  parser.add_argument('--convert', metavar='OUTPUT',
+                      help='convert a text trace to the binary format and exit')
+  parser.add_argument('-f', '--frames', type=int, default=DEFAULT_NUM_FRAMES,
+                      help='number of physical frames (default: %(default)s)')
+  parser.add_argument('-p', '--policies', default=','.join(DEFAULT_POLICIES),
+                      help='comma-separated policies to run, from ' +
+                           ', '.join(POLICIES) + ', or all '
+                           '(default: %(default)s)')
+  parser.add_argument('-c', '--curve', type=int, metavar='N',
+                      help='print the LRU miss-ratio curve for 1 to N frames')
+  parser.add_argument('--verify', action='store_true',
+                      help='check the miss-ratio curve against LRU runs')
+  parser.add_argument('--bench', action='store_true',
+                      help='report hit ratio and references per second for '
+                           'each policy instead of fault positions')
+  parser.add_argument('--sweep', metavar='DIR',
+                      help='run every policy on every trace in DIR for each '
+                           'of --sweep-frames, in parallel')
+  parser.add_argument('--sweep-frames', default=str(DEFAULT_NUM_FRAMES),
+                      help='comma-separated frame counts for --sweep '
+                           '(default: %(default)s)')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='worker processes for --sweep (default: all CPUs)')
+  parser.add_argument('-o', '--report', metavar='FILE',
+                      help='write the --sweep report to FILE, as JSON if it '
+                           'ends in .json and CSV otherwise (default: stdout)')
+  parser.add_argument('-g', '--generate', choices=sorted(GENERATORS),
+                      help='write a synthetic trace to the trace argument, '
+                           'in binary if it ends in .bin')
+  parser.add_argument('-n', '--length', type=int, default=1000000,
+                      help='references to generate (default: %(default)s)')
+  parser.add_argument('--pages', type=int, default=1024,
+                      help='distinct pages in a generated trace '
+                           '(default: %(default)s)')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='random seed for --generate (default: %(default)s)')
+  parser.add_argument('--regress', metavar='BASELINE',
+                      help='check the goldens, benchmark the trace and fail '
+                           'if throughput drops below the BASELINE JSON')
+  parser.add_argument('--threshold', type=float, default=0.2,
+                      help='allowed fractional throughput drop for --regress '
+                           '(default: %(default)s)')
+  parser.add_argument('--update-baseline', action='store_true',
+                      help='record this --regress run as the new baseline')
+  args = parser.parse_args()
+
+  if args.frames < 1:
+    parser.error('--frames must be at least 1')
+  try:
+    frame_counts = [int(f) for f in args.sweep_frames.split(',')]
+  except ValueError:
+    parser.error('--sweep-frames must be comma-separated integers')
+  if any(frames < 1 for frames in frame_counts):
+    parser.error('--sweep-frames must all be at least 1')
+
+  if args.generate:
+    if not args.trace:
+      parser.error('--generate needs an output trace file')
+    generator = GENERATORS[args.generate]
+    write_trace(generator(args.length, args.pages, random.Random(args.seed)),
+                args.trace)
+    return
+
+  names = list(POLICIES) if args.policies == 'all' else args.policies.split(',')
+  for name in names:
+    if name not in POLICIES:
+      parser.error('unknown policy: ' + name)
+
+  if args.sweep:
+    results = sweep(list_traces(args.sweep), names, frame_counts, args.jobs)
+    write_report(results, args.report)
+    return
+
+  if args.convert:
+    convert_text_to_binary(args.trace, args.convert)
+    return
 
-def generate_pm():
-  return list(range(SIZE))
+  if args.binary:
+    # Binary traces are mapped from a file, so stdin will not do
+    if not args.trace:
+      parser.error('--binary needs a trace file')
+    chunks = read_binary_trace(args.trace)
+  elif args.trace:
+    chunks = read_text_trace(open(args.trace, 'r'))
+  else:
+    chunks = read_text_trace(sys.stdin)
+
+  if args.curve:
+    # The curve needs the whole reference string for its time index
+    rs = [page for chunk in chunks for page in chunk]
+    curve = lru_fault_curve(rs, args.curve)
+    if args.verify:
+      verify_fault_curve(rs, curve)
+    print_fault_curve(curve, len(rs))
+    return
+
+  if args.bench:
+    rs = [page for chunk in chunks for page in chunk]
+    print_benchmark(benchmark(rs, names, args.frames))
+    return
+
+  if args.regress:
+    rs = [page for chunk in chunks for page in chunk]
+    failures = check_goldens()
+    results = benchmark(rs, names, args.frames)
+    print_benchmark(results)
+    failures.extend(check_regression(results, args.frames, trace_digest(rs),
+                                     args.regress, args.threshold,
+                                     args.update_baseline))
+    for failure in failures:
+      print 'FAIL', failure
+    sys.exit(1 if failures else 0)
+
+  rs = None
+  if any(POLICIES[name].needs_trace for name in names):
+    # Offline policies look ahead, so the trace is read in full up front
+    rs = [page for chunk in chunks for page in chunk]
+    chunks = [rs]
+  policies = [make_policy(name, args.frames, rs) for name in names]
+  for page_faults in run_policies(policies, chunks):
+    print_faults(page_faults)
+
+def generate_pm(frames):
+  return list(range(frames))
 
 def print_faults(page_faults):
   output = [len(page_faults)]
   output.extend(page_faults)
   print ' '.join([str(f) for f in output])
 
-def fifo(rs):
-  pm = generate_pm()
-  pages = set(pm)
-  page_faults = []
-  pointer_index = 0
-  for time, page in enumerate(rs):
-    if page not in pages:
-      page_faults.append(time + 1)
-      pages.remove(pm[pointer_index])
-      pages.add(page)
-      pm[pointer_index] = page
-      pointer_index = (pointer_index + 1) % SIZE
-  print_faults(page_faults)
-
-def lru(rs):
-  pm = generate_pm()
-  pages = set(pm)
-  page_faults = []
-  queue = pm[:] # reverse of the pm
-  for time, page in enumerate(rs):
-    if page not in pages:
-      page_faults.append(time + 1)
-      pages.remove(queue[0])
-      queue.pop(0)
-      pages.add(page)
-      queue.append(page)
+def read_text_trace(f, chunk_size=CHUNK_SIZE):
+  # Yields lists of page numbers, reading chunk_size bytes at a time. A token
+  # split across two reads is carried over to the next chunk.
+  partial = ''
+  while True:
+    data = f.read(chunk_size)
+    if not data:
+      break
+    data = partial + data
+    tokens = data.split()
+    if tokens and not data[-1].isspace():
+      partial = tokens.pop()
+    else:
+      partial = ''
+    if tokens:
+      yield [int(p) for p in tokens]
+  if partial:
+    yield [int(partial)]
+
+def read_binary_trace(name, chunk_size=CHUNK_SIZE):
+  # Yields lists of at most chunk_size page numbers straight off a memory map
+  with open(name, 'rb') as f:
+    f.seek(0, 2)
+    count = f.tell() // BINARY_ITEM_SIZE
+    if count == 0:
+      return
+    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for start in range(0, count, chunk_size):
+        n = min(chunk_size, count - start)
+        yield list(struct.unpack_from('<%dI' % n, mapping,
+                                      start * BINARY_ITEM_SIZE))
+    finally:
+      mapping.close()
+
+def write_trace(chunks, name):
+  # Binary if the name ends in .bin, otherwise one space-separated text line
+  binary = name.endswith('.bin')
+  with open(name, 'wb' if binary else 'w') as out:
+    first = True
+    for chunk in chunks:
+      if binary:
+        out.write(struct.pack('<%dI' % len(chunk), *chunk))
+      elif chunk:
+        if not first:
+          out.write(' ')
+        out.write(' '.join(str(p) for p in chunk))
+        first = False
+    if not binary:
+      out.write('\n')
+
+def convert_text_to_binary(source, destination):
+  f = open(source, 'r') if source else sys.stdin
+  with open(destination, 'wb') as out:
+    for chunk in read_text_trace(f):
+      out.write(struct.pack('<%dI' % len(chunk), *chunk))
+
+def chunked(length, make_chunk):
+  for start in range(0, length, CHUNK_SIZE):
+    yield make_chunk(start, min(CHUNK_SIZE, length - start))
+
+def generate_zipf(length, pages, rng, alpha=1.0):
+  # Page i is drawn with probability proportional to 1 / (i + 1) ** alpha
+  cdf = []
+  total = 0.0
+  for i in range(pages):
+    total += 1.0 / (i + 1) ** alpha
+    cdf.append(total)
+  last = pages - 1
+  def make_chunk(start, n):
+    return [min(bisect.bisect(cdf, rng.random() * total), last)
+            for _ in range(n)]
+  return chunked(length, make_chunk)
+
+def generate_loop(length, pages, rng):
+  return chunked(length, lambda start, n:
+                 [t % pages for t in range(start, start + n)])
+
+def generate_scan(length, pages, rng):
+  # Every reference touches a new page
+  return chunked(length, lambda start, n: list(range(start, start + n)))
+
+def generate_phases(length, pages, rng, working_set=64, phase_length=100000):
+  # Uniform references within a working set that jumps to a new region of
+  # the address space every phase_length references
+  working_set = min(working_set, pages)
+  def make_chunk(start, n):
+    chunk = []
+    for t in range(start, start + n):
+      base = (t // phase_length) * working_set % (pages - working_set + 1)
+      chunk.append(base + rng.randrange(working_set))
+    return chunk
+  return chunked(length, make_chunk)
+
+GENERATORS = {
+  'zipf': generate_zipf,
+  'loop': generate_loop,
+  'scan': generate_scan,
+  'phases': generate_phases,
+}
+
+def open_trace(name):
+  # Binary traces are recognised by their .bin extension
+  if name.endswith('.bin'):
+    return read_binary_trace(name)
+  return read_text_trace(open(name, 'r'))
+
+def list_traces(directory):
+  return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+          if os.path.isfile(os.path.join(directory, name))]
+
+def run_sweep_job(job):
+  # Runs in a worker process, so it reads its own copy of the trace
+  trace, name, frames = job
+  chunks = open_trace(trace)
+  rs = None
+  if POLICIES[name].needs_trace:
+    rs = [page for chunk in chunks for page in chunk]
+    chunks = [rs]
+  page_faults, = run_policies([make_policy(name, frames, rs)], chunks)
+  return {'trace': trace, 'policy': name, 'frames': frames,
+          'faults': len(page_faults), 'fault_positions': page_faults}
+
+def sweep(traces, names, frame_counts, jobs=None):
+  work = [(trace, name, frames) for trace in traces
+          for name in names for frames in frame_counts]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    results = pool.map(run_sweep_job, work, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return results
+
+def write_report(results, name=None):
+  out = open(name, 'w') if name else sys.stdout
+  try:
+    if name and name.endswith('.json'):
+      json.dump(results, out, indent=2)
+      out.write('\n')
+    else:
+      fields = ['trace', 'policy', 'frames', 'faults', 'fault_positions']
+      writer = csv.DictWriter(out, fields)
+      writer.writeheader()
+      for result in results:
+        row = dict(result)
+        row['fault_positions'] = ' '.join(str(f) for f in result['fault_positions'])
+        writer.writerow(row)
+  finally:
+    if name:
+      out.close()
+
+def run_policies(policies, chunks):
+  # Feeds one shared pass over the trace to every policy, so no policy needs
+  # its own copy of the reference string
+  page_faults = [[] for policy in policies]
+  time = 0
+  for chunk in chunks:
+    for policy, faults in zip(policies, page_faults):
+      reference = policy.reference
+      for offset, page in enumerate(chunk, time + 1):
+        if reference(page):
+          faults.append(offset)
+    time += len(chunk)
+  return page_faults
+
+class ReplacementPolicy(object):
+  # Physical memory starts out holding pages 0 to frames - 1. Subclasses
+  # implement reference(page), which returns True when the page faults.
+  # Policies with needs_trace set also take the whole reference string.
+  needs_trace = False
+
+  def __init__(self, frames):
+    self.frames = frames
+
+  def reference(self, page):
+    raise NotImplementedError
+
+  def run(self, rs):
+    page_faults = []
+    for time, page in enumerate(rs):
+      if self.reference(page):
+        page_faults.append(time + 1)
+    return page_faults
+
+class FIFOPolicy(ReplacementPolicy):
+  def __init__(self, frames):
+    super(FIFOPolicy, self).__init__(frames)
+    self.pm = generate_pm(frames)
+    self.pages = set(self.pm)
+    self.pointer_index = 0
+
+  def reference(self, page):
+    if page in self.pages:
+      return False
+    self.pages.remove(self.pm[self.pointer_index])
+    self.pages.add(page)
+    self.pm[self.pointer_index] = page
+    self.pointer_index = (self.pointer_index + 1) % self.frames
+    return True
+
+class LRUPolicy(ReplacementPolicy):
+  def __init__(self, frames):
+    super(LRUPolicy, self).__init__(frames)
+    # Ordered from least to most recently used; OrderedDict is a hashed
+    # doubly linked list, so both the lookup and the reordering are O(1)
+    self.queue = OrderedDict((p, None) for p in generate_pm(frames))
+
+  def reference(self, page):
+    if page in self.queue:
+      del self.queue[page]
+      self.queue[page] = None
+      return False
+    self.queue.popitem(last=False)
+    self.queue[page] = None
+    return True
+
+class SecondChancePolicy(ReplacementPolicy):
+  def __init__(self, frames):
+    super(SecondChancePolicy, self).__init__(frames)
+    self.pm = generate_pm(frames)
+    self.bits = dict([(p, 1) for p in self.pm])
+    self.pointer_index = 0
+
+  def reference(self, page):
+    fault = page not in self.bits
+    if fault:
+      while self.bits[self.pm[self.pointer_index]] == 1:
+        self.bits[self.pm[self.pointer_index]] = 0
+        self.pointer_index = (self.pointer_index + 1) % self.frames
+      del self.bits[self.pm[self.pointer_index]]
+      self.pm[self.pointer_index] = page
+      self.pointer_index = (self.pointer_index + 1) % self.frames
+    self.bits[page] = 1
+    return fault
+
+def compute_next_use(rs):
+  # Single backward pass: next_use[t] is the time page rs[t] is referenced
+  # again, or len(rs) if never. Also returns each page's first use.
+  n = len(rs)
+  next_use = [n] * n
+  upcoming = {}
+  for time in range(n - 1, -1, -1):
+    page = rs[time]
+    next_use[time] = upcoming.get(page, n)
+    upcoming[page] = time
+  return next_use, upcoming
+
+class OPTPolicy(ReplacementPolicy):
+  needs_trace = True
+
+  def __init__(self, frames, rs):
+    super(OPTPolicy, self).__init__(frames)
+    self.next_use, first_use = compute_next_use(rs)
+    self.time = 0
+    # Resident pages mapped to their next use. The max-heap is keyed by next
+    # use with lazy deletion: an entry is stale once its page has moved on.
+    self.resident = dict((p, first_use.get(p, len(rs)))
+                         for p in generate_pm(frames))
+    self.heap = [(-t, p) for p, t in self.resident.items()]
+    heapq.heapify(self.heap)
+
+  def reference(self, page):
+    next_use = self.next_use[self.time]
+    self.time += 1
+    fault = page not in self.resident
+    if fault:
+      while True:
+        key, victim = heapq.heappop(self.heap)
+        if self.resident.get(victim) == -key:
+          break
+      del self.resident[victim]
+    self.resident[page] = next_use
+    heapq.heappush(self.heap, (-next_use, page))
+    if len(self.heap) > 2 * self.frames:
+      # Drop stale entries so the heap stays O(frames)
+      self.heap = [(-t, p) for p, t in self.resident.items()]
+      heapq.heapify(self.heap)
+    return fault
+
+class ARCPolicy(ReplacementPolicy):
+  # Adaptive Replacement Cache (Megiddo and Modha). T1 holds pages seen once
+  # recently and T2 pages seen at least twice; B1 and B2 remember what was
+  # evicted from each. Hits in B1/B2 shift the target size p of T1.
+  def __init__(self, frames):
+    super(ARCPolicy, self).__init__(frames)
+    self.t1 = OrderedDict((p, None) for p in generate_pm(frames))
+    self.t2 = OrderedDict()
+    self.b1 = OrderedDict()
+    self.b2 = OrderedDict()
+    self.p = 0
+
+  def replace(self, page):
+    if self.t1 and (len(self.t1) > self.p or
+                    (page in self.b2 and len(self.t1) == self.p)):
+      victim, _ = self.t1.popitem(last=False)
+      self.b1[victim] = None
+    else:
+      victim, _ = self.t2.popitem(last=False)
+      self.b2[victim] = None
+
+  def reference(self, page):
+    if page in self.t1:
+      del self.t1[page]
+      self.t2[page] = None
+      return False
+    if page in self.t2:
+      del self.t2[page]
+      self.t2[page] = None
+      return False
+
+    if page in self.b1:
+      self.p = min(self.frames, self.p + max(len(self.b2) // len(self.b1), 1))
+      self.replace(page)
+      del self.b1[page]
+      self.t2[page] = None
+      return True
+    if page in self.b2:
+      self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+      self.replace(page)
+      del self.b2[page]
+      self.t2[page] = None
+      return True
+
+    if len(self.t1) + len(self.b1) == self.frames:
+      if len(self.t1) < self.frames:
+        self.b1.popitem(last=False)
+        self.replace(page)
+      else:
+        self.t1.popitem(last=False)
+    else:
+      total = len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2)
+      if total >= self.frames:
+        if total == 2 * self.frames:
+          self.b2.popitem(last=False)
+        self.replace(page)
+    self.t1[page] = None
+    return True
+
+class TwoQPolicy(ReplacementPolicy):
+  # Full 2Q (Johnson and Shasha). First references go through the A1in FIFO;
+  # pages evicted from it are remembered in A1out, and a fault on a page in
+  # A1out promotes it to the Am LRU queue.
+  def __init__(self, frames):
+    super(TwoQPolicy, self).__init__(frames)
+    self.in_size = max(1, frames // 4)
+    self.out_size = max(1, frames // 2)
+    self.a1in = OrderedDict((p, None) for p in generate_pm(frames))
+    self.a1out = OrderedDict()
+    self.am = OrderedDict()
+
+  def reclaim(self):
+    if len(self.a1in) + len(self.am) < self.frames:
+      return
+    if len(self.a1in) > self.in_size or not self.am:
+      victim, _ = self.a1in.popitem(last=False)
+      self.a1out[victim] = None
+      if len(self.a1out) > self.out_size:
+        self.a1out.popitem(last=False)
+    else:
+      self.am.popitem(last=False)
+
+  def reference(self, page):
+    if page in self.am:
+      del self.am[page]
+      self.am[page] = None
+      return False
+    if page in self.a1in:
+      return False
+    self.reclaim()
+    if page in self.a1out:
+      del self.a1out[page]
+      self.am[page] = None
     else:
-      queue.pop(queue.index(page))
-      queue.append(page)
-  print_faults(page_faults)
-
-def second_chance(rs):
-  pm = generate_pm()
-  bits = dict([(p, 1) for p in pm])
-  page_faults = []
-  pointer_index = 0
+      self.a1in[page] = None
+    return True
+
+class ClockProPage(object):
+  __slots__ = ['page', 'hot', 'referenced', 'test', 'resident', 'prev', 'next']
+
+  def __init__(self, page, hot=False, test=False):
+    self.page = page
+    self.hot = hot
+    self.referenced = False
+    self.test = test
+    self.resident = True
+    self.prev = self
+    self.next = self
+
+class ClockProPolicy(ReplacementPolicy):
+  # CLOCK-Pro (Jiang, Chen and Zhang). Resident pages are hot or cold, and a
+  # cold page stays on the clock in a test period, even after eviction, to
+  # find out whether its reuse distance is short enough to make it hot. The
+  # cold allocation grows when a page is re-referenced in its test period and
+  # shrinks when a test period expires. New pages go in at the list head,
+  # just behind the hot hand.
+  def __init__(self, frames):
+    super(ClockProPolicy, self).__init__(frames)
+    self.pages = {}
+    self.hand_hot = self.hand_cold = self.hand_test = None
+    self.count_hot = 0
+    self.count_cold = 0
+    self.count_test = 0
+    self.cold_target = frames
+    for p in generate_pm(frames):
+      self.insert(ClockProPage(p))
+      self.count_cold += 1
+
+  def insert(self, node):
+    self.pages[node.page] = node
+    if self.hand_hot is None:
+      node.prev = node.next = node
+      self.hand_hot = self.hand_cold = self.hand_test = node
+      return
+    head = self.hand_hot
+    node.prev = head.prev
+    node.next = head
+    head.prev.next = node
+    head.prev = node
+
+  def unlink(self, node):
+    successor = node.next if node.next is not node else None
+    if self.hand_hot is node:
+      self.hand_hot = successor
+    if self.hand_cold is node:
+      self.hand_cold = successor
+    if self.hand_test is node:
+      self.hand_test = successor
+    node.prev.next = node.next
+    node.next.prev = node.prev
+    node.prev = node.next = node
+
+  def remove(self, node):
+    self.unlink(node)
+    del self.pages[node.page]
+
+  def move_to_head(self, node):
+    self.unlink(node)
+    self.insert(node)
+
+  def end_test(self, node):
+    # Returns True when the node left the clock
+    if node.resident:
+      node.test = False
+      return False
+    self.remove(node)
+    self.count_test -= 1
+    self.cold_target = max(1, self.cold_target - 1)
+    return True
+
+  def run_hand_hot(self):
+    # Demotes one hot page, ending the test periods of cold pages it passes
+    while True:
+      node = self.hand_hot
+      if node.hot:
+        if node.referenced:
+          node.referenced = False
+        else:
+          node.hot = False
+          node.test = False
+          self.count_hot -= 1
+          self.count_cold += 1
+          self.hand_hot = node.next
+          return
+      elif self.end_test(node):
+        continue
+      self.hand_hot = self.hand_hot.next
+
+  def run_hand_test(self):
+    # Removes one non-resident cold page
+    while True:
+      node = self.hand_test
+      if not node.hot and self.end_test(node):
+        return
+      self.hand_test = self.hand_test.next
+
+  def balance(self):
+    while self.count_hot > self.frames - self.cold_target:
+      self.run_hand_hot()
+
+  def run_hand_cold(self):
+    # Evicts one resident cold page
+    while True:
+      node = self.hand_cold
+      if node.hot or not node.resident:
+        self.hand_cold = node.next
+      elif node.referenced:
+        node.referenced = False
+        if node.test:
+          node.hot = True
+          self.count_cold -= 1
+          self.count_hot += 1
+        else:
+          node.test = True
+        self.move_to_head(node)
+        self.balance()
+      else:
+        node.resident = False
+        self.count_cold -= 1
+        self.hand_cold = node.next
+        if node.test:
+          self.count_test += 1
+          while self.count_test > self.frames:
+            self.run_hand_test()
+        else:
+          self.remove(node)
+        return
+
+  def reference(self, page):
+    node = self.pages.get(page)
+    if node is not None and node.resident:
+      node.referenced = True
+      return False
+
+    if self.count_hot + self.count_cold >= self.frames:
+      self.run_hand_cold()
+    # The eviction may have ended this page's test period
+    node = self.pages.get(page)
+    if node is not None:
+      self.cold_target = min(self.frames, self.cold_target + 1)
+      self.remove(node)
+      self.count_test -= 1
+      self.insert(ClockProPage(page, hot=True))
+      self.count_hot += 1
+      self.balance()
+    else:
+      self.insert(ClockProPage(page, test=True))
+      self.count_cold += 1
+    return True
+
+POLICIES = OrderedDict([
+  ('fifo', FIFOPolicy),
+  ('lru', LRUPolicy),
+  ('second_chance', SecondChancePolicy),
+  ('opt', OPTPolicy),
+  ('arc', ARCPolicy),
+  ('2q', TwoQPolicy),
+  ('clock_pro', ClockProPolicy),
+])
+DEFAULT_POLICIES = ['fifo', 'lru', 'second_chance']
+
+def make_policy(name, frames, rs=None):
+  policy = POLICIES[name]
+  if policy.needs_trace:
+    return policy(frames, rs)
+  return policy(frames)
+
+def benchmark(rs, names, frames):
+  # Every policy replays the same in-memory trace; loading it is not timed
+  results = []
+  for name in names:
+    start = timeit.default_timer()
+    policy = make_policy(name, frames, rs)
+    faults = len(policy.run(rs))
+    elapsed = timeit.default_timer() - start
+    results.append((name, len(rs) - faults, len(rs), elapsed))
+  return results
+
+def print_benchmark(results):
+  print '{0:<14} {1:>10} {2:>12} {3:>9} {4:>14}'.format(
+      'policy', 'hits', 'references', 'hit ratio', 'refs/sec')
+  for name, hits, references, elapsed in results:
+    ratio = float(hits) / references if references else 0.0
+    rate = references / elapsed if elapsed > 0 else float('inf')
+    print '{0:<14} {1:>10} {2:>12} {3:>9.4f} {4:>14.0f}'.format(
+        name, hits, references, ratio, rate)
+
+def check_goldens():
+  # proj1/output/out*.txt hold the expected fifo, lru and second_chance
+  # faults for the matching proj1/input/in*.txt
+  failures = []
+  input_dir = os.path.join(GOLDEN_DIR, 'input')
+  for trace in list_traces(input_dir):
+    name = os.path.basename(trace)
+    frames = GOLDEN_FRAMES.get(name, DEFAULT_NUM_FRAMES)
+    golden = os.path.join(GOLDEN_DIR, 'output', name.replace('in', 'out', 1))
+    with open(golden, 'r') as f:
+      expected = [line.split() for line in f if line.strip()]
+    policies = [make_policy(n, frames) for n in DEFAULT_POLICIES]
+    actual = run_policies(policies, open_trace(trace))
+    for n, faults, line in zip(DEFAULT_POLICIES, actual, expected):
+      if [str(f) for f in [len(faults)] + faults] != line:
+        failures.append('%s %s does not match %s' % (name, n, golden))
+  return failures
+
+def trace_digest(rs):
+  # Length and SHA-1 of the reference string as packed in a binary trace,
+  # so the text and binary forms of a trace match
+  digest = hashlib.sha1()
+  for start in range(0, len(rs), CHUNK_SIZE):
+    chunk = rs[start:start+CHUNK_SIZE]
+    digest.update(struct.pack('<%dI' % len(chunk), *chunk))
+  return {'references': len(rs), 'sha1': digest.hexdigest()}
+
+def check_regression(results, frames, trace, baseline_name, threshold, update=False):
+  # The baseline JSON holds the digest of the trace it was recorded on and
+  # maps policy names to their faults and refs/sec. A baseline from any
+  # other trace, or without every policy run at this frame count, is
+  # refused rather than compared.
+  current = {}
+  for name, hits, references, elapsed in results:
+    current[name] = {'faults': references - hits, 'frames': frames,
+                     'refs_per_sec': references / elapsed if elapsed > 0 else 0}
+  failures = []
+  if update or not os.path.exists(baseline_name):
+    with open(baseline_name, 'w') as f:
+      json.dump({'trace': trace, 'policies': current}, f, indent=2, sort_keys=True)
+    return failures
+  with open(baseline_name, 'r') as f:
+    baseline = json.load(f)
+  if baseline.get('trace') != trace:
+    failures.append('%s was not recorded on this trace, rerun with '
+                    '--update-baseline to replace it' % baseline_name)
+    return failures
+  baseline = baseline['policies']
+  missing = [name for name in sorted(current) if name not in baseline]
+  if missing:
+    failures.append('%s has no results for %s, rerun with --update-baseline '
+                    'to replace it' % (baseline_name, ', '.join(missing)))
+  for name in sorted(current):
+    if name in baseline and baseline[name]['frames'] != frames:
+      failures.append('%s has %s at %d frames, not %d, rerun with '
+                      '--update-baseline to replace it' %
+                      (baseline_name, name, baseline[name]['frames'], frames))
+  if failures:
+    return failures
+  for name, result in sorted(current.items()):
+    expected = baseline[name]
+    if result['faults'] != expected['faults']:
+      failures.append('%s: %d faults, baseline has %d' %
+                      (name, result['faults'], expected['faults']))
+    floor = expected['refs_per_sec'] * (1 - threshold)
+    if result['refs_per_sec'] < floor:
+      failures.append('%s: %.0f refs/sec, below %.0f' %
+                      (name, result['refs_per_sec'], floor))
+  return failures
+
+def fifo(rs, frames=DEFAULT_NUM_FRAMES):
+  print_faults(FIFOPolicy(frames).run(rs))
+
+def lru(rs, frames=DEFAULT_NUM_FRAMES):
+  print_faults(LRUPolicy(frames).run(rs))
+
+def second_chance(rs, frames=DEFAULT_NUM_FRAMES):
+  print_faults(SecondChancePolicy(frames).run(rs))
+
+def opt(rs, frames=DEFAULT_NUM_FRAMES):
+  print_faults(OPTPolicy(frames, rs).run(rs))
+
+class FenwickTree(object):
+  def __init__(self, size):
+    self.size = size
+    self.tree = [0] * (size + 1)
+    self.total = 0
+
+  def add(self, index, delta):
+    self.total += delta
+    index += 1
+    while index <= self.size:
+      self.tree[index] += delta
+      index += index & -index
+
+  def prefix_sum(self, index):
+    # Sum of positions 0 to index inclusive
+    result = 0
+    index += 1
+    while index > 0:
+      result += self.tree[index]
+      index -= index & -index
+    return result
+
+  def find_kth(self, k):
+    # Smallest position whose prefix sum reaches k
+    position = 0
+    step = 1
+    while step * 2 <= self.size:
+      step *= 2
+    while step > 0:
+      if position + step <= self.size and self.tree[position + step] < k:
+        position += step
+        k -= self.tree[position]
+      step //= 2
+    return position
+
+def lru_fault_curve(rs, max_frames):
+  # Mattson stack distances in a single pass. Each reference faults for every
+  # frame count below its threshold, so faults[k] counts thresholds above k.
+  # Reference times still on the LRU stack are marked in a Fenwick tree, which
+  # turns a stack distance into two prefix sums.
+  #
+  # Frames start out holding pages 0 to k - 1 with page 0 least recently used,
+  # which differs for each k. The first reference of page j < k hits iff at
+  # least A - j of the A distinct pages seen so far lie in (j, k), so a second
+  # Fenwick tree over page values finds the smallest k for which that holds.
+  values = sorted(set(rs))
+  rank = dict((page, i) for i, page in enumerate(values))
+  times = FenwickTree(len(rs))
+  seen = FenwickTree(len(values))
+  last_use = {}
+  thresholds = [0] * (max_frames + 2)
   for time, page in enumerate(rs):
-    if page not in bits:
-      page_faults.append(time + 1)
-      while bits[pm[pointer_index]] == 1:
-        bits[pm[pointer_index]] = 0
-        pointer_index = (pointer_index + 1) % SIZE
-      del bits[pm[pointer_index]]
-      pm[pointer_index] = page
-      pointer_index = (pointer_index + 1) % SIZE
-    bits[page] = 1
-  print_faults(page_faults)
+    if page in last_use:
+      previous = last_use[page]
+      threshold = times.total - times.prefix_sum(previous) + 1
+      times.add(previous, -1)
+    else:
+      threshold = max_frames + 1
+      if 0 <= page < max_frames:
+        needed = len(last_use) - page
+        below = seen.prefix_sum(rank[page])
+        if needed <= 0:
+          threshold = page + 1
+        elif seen.total - below >= needed:
+          threshold = values[seen.find_kth(below + needed)] + 1
+      seen.add(rank[page], 1)
+    times.add(time, 1)
+    last_use[page] = time
+    thresholds[min(threshold, max_frames + 1)] += 1
+
+  faults = [0] * (max_frames + 2)
+  for frames in range(max_frames, 0, -1):
+    faults[frames] = faults[frames + 1] + thresholds[frames + 1]
+  return faults[1:max_frames + 1]
+
+def verify_fault_curve(rs, curve):
+  for frames, fault_count in enumerate(curve, 1):
+    expected = len(LRUPolicy(frames).run(rs))
+    if fault_count != expected:
+      raise AssertionError('%d frames: curve has %d faults, lru has %d' %
+                           (frames, fault_count, expected))
+
+def print_fault_curve(curve, num_references):
+  for frames, fault_count in enumerate(curve, 1):
+    ratio = float(fault_count) / num_references if num_references else 0.0
+    print '{0} {1} {2:.4f}'.format(frames, fault_count, ratio)
 
 if __name__ == "__main__":
   main()
@@ -1,151 +1,672 @@
 #!/bin/python
 
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from heapq import heappush, heappop
 from math import *
-from copy import *
+
+MLF_LEVELS = 5
+MLF_QUANTUM = 1
+MLF_GROWTH = 2
+CHUNK_SIZE = 1 << 16
+# Set by --instrument; schedulers are only wrapped with counters when True
+INSTRUMENT = False
+instrumentation = OrderedDict()
 
 def main():
+  parser = argparse.ArgumentParser(description='Process scheduling simulator')
+  parser.add_argument('--levels', type=int, default=MLF_LEVELS,
+                      help='number of MLF priority levels (default: %(default)s)')
+  parser.add_argument('--quantum', type=int, default=MLF_QUANTUM,
+                      help='MLF quantum of the top level (default: %(default)s)')
+  parser.add_argument('--growth', type=int, default=MLF_GROWTH,
+                      help='factor by which the MLF quantum grows per level '
+                           '(default: %(default)s)')
+  parser.add_argument('--stream', metavar='FILE',
+                      help='read arrival-ordered jobs from FILE (- for stdin) '
+                           'in chunks and print rolling statistics')
+  parser.add_argument('--algorithms', default=','.join(ALGORITHMS),
+                      help='comma-separated algorithms for --stream and '
+                           '--sweep (default: %(default)s)')
+  parser.add_argument('--report-every', type=int, default=0, metavar='N',
+                      help='print statistics every N completed jobs in '
+                           '--stream mode (default: only at the end)')
+  parser.add_argument('--sweep', action='store_true',
+                      help='run every algorithm on many workloads in parallel '
+                           'and print one merged table')
+  parser.add_argument('--workload-dir', metavar='DIR',
+                      help='sweep the workload files in DIR instead of '
+                           'generating workloads')
+  parser.add_argument('--generate', metavar='FILE',
+                      help='write one generated workload to FILE and exit')
+  parser.add_argument('--workloads', type=int, default=10,
+                      help='generated workloads per load factor and service '
+                           'distribution (default: %(default)s)')
+  parser.add_argument('--num-jobs', type=int, default=10000,
+                      help='jobs per generated workload (default: %(default)s)')
+  parser.add_argument('--loads', default='0.5,0.8,0.95',
+                      help='comma-separated load factors (default: %(default)s)')
+  parser.add_argument('--distributions', default=','.join(SERVICE_DISTRIBUTIONS),
+                      help='comma-separated service time distributions, from ' +
+                           ', '.join(SERVICE_DISTRIBUTIONS) +
+                           ' (default: %(default)s)')
+  parser.add_argument('--mean-service', type=float, default=10.0,
+                      help='mean generated service time (default: %(default)s)')
+  parser.add_argument('--quanta', default=None,
+                      help='comma-separated MLF base quanta to sweep '
+                           '(default: --quantum)')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='base random seed for generated workloads '
+                           '(default: %(default)s)')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='worker processes for --sweep (default: all CPUs)')
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='also write the --sweep table to FILE as CSV')
+  parser.add_argument('--instrument', metavar='FILE',
+                      help='count scheduler events, time each algorithm and '
+                           'write the results to FILE as JSON')
+  args = parser.parse_args()
+
+  global INSTRUMENT
+  INSTRUMENT = args.instrument is not None
+
+  names = args.algorithms.split(',')
+  for name in names:
+    if name not in ALGORITHMS:
+      parser.error('unknown algorithm: ' + name)
+  # A quantum of 0 would stop the clock and 0 levels leave nowhere to queue
+  for option, value in [('--levels', args.levels), ('--quantum', args.quantum),
+                        ('--growth', args.growth)]:
+    if value < 1:
+      parser.error(option + ' must be at least 1')
+  if args.quanta and any(int(q) < 1 for q in args.quanta.split(',')):
+    parser.error('--quanta must all be at least 1')
+  mlf_params = (args.levels, args.quantum, args.growth)
+
+  if args.generate:
+    load = float(args.loads.split(',')[0])
+    distribution = args.distributions.split(',')[0]
+    input_str = generate_workload(args.num_jobs, load, distribution,
+                                  args.mean_service,
+                                  workload_rng(distribution, load, args.seed))
+    with open(args.generate, 'w') as f:
+      f.write(' '.join(str(p) for p in input_str) + '\n')
+    return
+
+  if args.sweep:
+    if args.workload_dir:
+      workloads = [('file', os.path.join(args.workload_dir, name))
+                   for name in sorted(os.listdir(args.workload_dir))]
+    else:
+      workloads = []
+      for load in [float(l) for l in args.loads.split(',')]:
+        for distribution in args.distributions.split(','):
+          for i in range(args.workloads):
+            workloads.append(('generated', args.num_jobs, load, distribution,
+                              args.mean_service, args.seed + i))
+    quanta = [int(q) for q in args.quanta.split(',')] if args.quanta else [args.quantum]
+    params = [(args.levels, quantum, args.growth) for quantum in quanta]
+    results = sweep(workloads, names, params, args.jobs)
+    print_sweep(results, args.output)
+    return
+
+  if args.stream:
+    if args.stream == '-' and len(names) > 1:
+      parser.error('stdin can only be streamed through one algorithm')
+    for name in names:
+      f = sys.stdin if args.stream == '-' else open(args.stream, 'r')
+      scheduler = lambda processes: make_scheduler(name, processes, mlf_params)
+      stream(name, StreamTable(f), scheduler, args.report_every)
+    write_instrumentation(args.instrument)
+    return
+
   input_str = [int(p.strip()) for p in raw_input().split(' ') if p != '']
-  processes = []
-  for i in range(len(input_str)//2):
-    process = { 'process_id': i, 
-                'arrival_time': input_str[i*2], 
-                'service_time': input_str[i*2+1]
-              }
-    processes.append(process)
-  processes.sort(key=lambda x:x['arrival_time'])
-  
-  fifo(deepcopy(processes))
-  sjf(deepcopy(processes))
-  srt(deepcopy(processes))
-  mlf(deepcopy(processes))
+  processes = ProcessTable(input_str)
+
+  fifo(processes)
+  sjf(processes)
+  srt(processes)
+  mlf(processes, args.levels, args.quantum, args.growth)
+  write_instrumentation(args.instrument)
+
+class ProcessTable(object):
+  # Read-only columns, one row per process in order of arrival (ties keep
+  # input order). Schedulers refer to a process by its row and keep their
+  # own mutable state in separate arrays.
+  def __init__(self, input_str):
+    n = len(input_str) // 2
+    rows = sorted(range(n), key=lambda i: input_str[i*2])
+    self.process_id = array('l', rows)
+    self.arrival_time = array('l', [input_str[i*2] for i in rows])
+    self.service_time = array('l', [input_str[i*2+1] for i in rows])
+
+  def __len__(self):
+    return len(self.process_id)
+
+  def pending(self, row):
+    return row < len(self.process_id)
+
+  def column(self):
+    return array('l', [0]) * len(self.process_id)
+
+  def release(self, row):
+    pass
+
+class StreamTable(object):
+  # Same interface as ProcessTable, but rows are read from f on demand and
+  # dropped once their process completes, so only live processes are held
+  def __init__(self, f, chunk_size=CHUNK_SIZE):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.partial = ''
+    self.leftover = []
+    self.loaded = 0
+    self.last_arrival = 0
+    self.exhausted = False
+    self.columns = []
+    self.process_id = self.column()
+    self.arrival_time = self.column()
+    self.service_time = self.column()
+
+  def column(self):
+    column = defaultdict(int)
+    self.columns.append(column)
+    return column
+
+  def release(self, row):
+    for column in self.columns:
+      column.pop(row, None)
+
+  def pending(self, row):
+    while row >= self.loaded and not self.exhausted:
+      self.load_chunk()
+    return row < self.loaded
+
+  def load_chunk(self):
+    data = self.f.read(self.chunk_size)
+    if not data:
+      self.exhausted = True
+      tokens = [self.partial] if self.partial else []
+      self.partial = ''
+    else:
+      data = self.partial + data
+      tokens = data.split()
+      if tokens and not data[-1].isspace():
+        self.partial = tokens.pop()
+      else:
+        self.partial = ''
+    values = self.leftover + [int(p) for p in tokens]
+    pairs = len(values) // 2
+    self.leftover = values[pairs*2:]
+    for i in range(pairs):
+      arrival_time = values[i*2]
+      if arrival_time < self.last_arrival:
+        raise ValueError('job %d arrives before the job ahead of it' % self.loaded)
+      self.last_arrival = arrival_time
+      self.process_id[self.loaded] = self.loaded
+      self.arrival_time[self.loaded] = arrival_time
+      self.service_time[self.loaded] = values[i*2+1]
+      self.loaded += 1
 
 def print_real_times(real_times):
-  real_times.sort(key=lambda x:x[0])
-  real_times = [x[1] for x in real_times]
+  # real_times is indexed by process id
   average = float(int(float(sum(real_times))/len(real_times) * 100))/100
   print '{0:.2f} {1}'.format(average, ' '.join([str(f) for f in real_times]))
 
-def fifo(processes):
-  real_times = []
+def run_events(processes, scheduler, record):
+  # Discrete-event core: instead of stepping one tick at a time, the clock
+  # jumps to the next arrival, completion or end of the scheduler's time
+  # slice. record(process_id, real_time, current_time) is called for each
+  # completed process.
+  arrival_time = processes.arrival_time
+  service_time = processes.service_time
+  remaining_time = processes.column()
   current_time = 0
-  while len(processes) > 0:
-    # Update priority of all processes
-    current_time = max(min([process['arrival_time'] for process in processes]), current_time)
-    for process in processes:
-      process['priority'] = current_time - process['arrival_time']
-    processes.sort(key=lambda x:x['priority'], reverse=True)
-    current_process = processes[0]
-    real_times.append((current_process['process_id'], current_time - current_process['arrival_time'] + current_process['service_time']))
-    current_time += current_process['service_time']
-    processes.pop(0)
-  print_real_times(real_times)
+  next_arrival = 0
+  while processes.pending(next_arrival) or scheduler.has_ready():
+    while (processes.pending(next_arrival) and
+           arrival_time[next_arrival] <= current_time):
+      remaining_time[next_arrival] = service_time[next_arrival]
+      scheduler.arrive(next_arrival)
+      next_arrival += 1
+    if not scheduler.has_ready():
+      current_time = arrival_time[next_arrival]
+      continue
+
+    process, time_slice = scheduler.dispatch()
+    run_time = remaining_time[process]
+    if time_slice is not None:
+      run_time = min(run_time, time_slice)
+    if processes.pending(next_arrival):
+      run_time = min(run_time, arrival_time[next_arrival] - current_time)
+    current_time += run_time
+    remaining_time[process] -= run_time
+
+    if remaining_time[process] == 0:
+      scheduler.complete(process)
+      record(processes.process_id[process],
+             current_time - arrival_time[process], current_time)
+      processes.release(process)
+    else:
+      scheduler.preempt(process, run_time, remaining_time[process])
+
+def run_batch(processes, scheduler):
+  real_times = array('l', [0]) * len(processes)
+  def record(process_id, real_time, current_time):
+    real_times[process_id] = real_time
+  run_events(processes, scheduler, record)
+  return real_times
+
+class FIFOScheduler(object):
+  # Non-preemptive: the head of the queue keeps the CPU until it completes
+  def __init__(self, processes):
+    self.ready = deque()
+
+  def has_ready(self):
+    return len(self.ready) > 0
+
+  def push(self, process):
+    self.ready.append(process)
+
+  def pop(self):
+    return self.ready.popleft()
+
+  def arrive(self, process):
+    self.push(process)
+
+  def dispatch(self):
+    return self.ready[0], None
+
+  def preempt(self, process, run_time, remaining_time):
+    pass
+
+  def complete(self, process):
+    self.pop()
+
+def fifo(processes):
+  print_real_times(simulate('fifo', processes))
+
+class SJFScheduler(object):
+  # Non-preemptive: ready processes wait in a heap keyed by service time,
+  # with ties going to the earliest arrival
+  def __init__(self, processes):
+    self.service_time = processes.service_time
+    self.ready = []
+    self.running = None
+
+  def has_ready(self):
+    return self.running is not None or len(self.ready) > 0
+
+  def push(self, key, process):
+    heappush(self.ready, (key, process))
+
+  def pop(self):
+    return heappop(self.ready)[1]
+
+  def arrive(self, process):
+    self.push(self.service_time[process], process)
+
+  def dispatch(self):
+    if self.running is None:
+      self.running = self.pop()
+    return self.running, None
+
+  def preempt(self, process, run_time, remaining_time):
+    pass
+
+  def complete(self, process):
+    self.running = None
 
 def sjf(processes):
-  real_times = []
-  current_time = 0
-  while len(processes) > 0:
-    # Update priority of all processes
-    current_time = max(min([process['arrival_time'] for process in processes]), current_time)
-    available_processes = [p for p in processes if p['arrival_time'] <= current_time]
-    for process in available_processes:
-      process['priority'] = process['service_time']
-    available_processes.sort(key=lambda x:x['priority'])
-    current_process = available_processes[0]
-    real_times.append((current_process['process_id'], current_time - current_process['arrival_time'] + current_process['service_time']))
-    current_time += current_process['service_time']
-    processes = [p for p in processes if p['process_id'] != current_process['process_id']]
-  print_real_times(real_times)
+  print_real_times(simulate('sjf', processes))
+
+class SRTScheduler(object):
+  # Ready processes in a heap keyed by remaining time; ties go to the
+  # earliest arrival. The running process stays out of the heap until a
+  # ready one has less time left.
+  def __init__(self, processes):
+    self.service_time = processes.service_time
+    self.ready = []
+    self.running = None
+    self.running_key = None
+
+  def has_ready(self):
+    return self.running is not None or len(self.ready) > 0
+
+  def push(self, key, process):
+    heappush(self.ready, (key, process))
+
+  def pop(self):
+    return heappop(self.ready)[1]
+
+  def arrive(self, process):
+    self.push(self.service_time[process], process)
+
+  def dispatch(self):
+    if (self.running is not None and self.ready and
+        self.ready[0] < (self.running_key, self.running)):
+      self.push(self.running_key, self.running)
+      self.running = None
+    if self.running is None:
+      self.running_key = self.ready[0][0]
+      self.running = self.pop()
+    return self.running, None
+
+  def preempt(self, process, run_time, remaining_time):
+    self.running_key = remaining_time
+
+  def complete(self, process):
+    self.running = None
 
 def srt(processes):
-  real_times = []
-  current_time = 0
-  for process in processes:
-    process['remaining_time'] = process['service_time']
-    process['waiting_time'] = 0
-
-  while len(processes) > 0:
-    # Update priority of all processes
-    available_processes = [p for p in processes if p['arrival_time'] <= current_time]
-    for process in available_processes:
-      process['priority'] = -process['remaining_time']
-      process['waiting_time'] += 1
-    available_processes.sort(key=lambda x:x['priority'], reverse=True)
-    if (len(available_processes) > 0):
-      current_process = available_processes[0]
-      current_process['waiting_time'] -= 1
-      current_process['remaining_time'] -= 1
-      if (current_process['remaining_time'] == 0):
-        real_times.append((current_process['process_id'], current_process['waiting_time'] + current_process['service_time']))
-        processes = [p for p in processes if p['process_id'] != current_process['process_id']]
-    current_time += 1
-  print_real_times(real_times)
+  print_real_times(simulate('srt', processes))
 
-import time
+class MLFScheduler(object):
+  # Level i has a quantum of T * growth ** i. A process that uses up its
+  # quantum moves down a level; the last level is round robin. Bit i of
+  # nonempty is set while level i has processes, so the top level is its
+  # lowest set bit.
+  def __init__(self, processes, N, T, growth):
+    assert N >= 1 and T >= 1 and growth >= 1
+    self.N = N
+    self.quantum = [T * growth ** i for i in range(N)]
+    self.priority_levels = [deque() for i in range(N)]
+    self.nonempty = 0
+    self.level = processes.column()
+    self.time_received = processes.column()
 
-def mlf(processes):
-  N = 5
-  T = 1
-  real_times = []
-  current_time = 0
-  for process in processes:
-    process['waiting_time'] = 0
-    process['remaining_time'] = process['service_time']
-
-  priority_levels = []
-  for i in range(N):
-    priority_levels.append([])
-
-  def processes_remaining(priority_levels):
-    return sum([len(pq) for pq in priority_levels])
-
-  def print_pq(priority_levels):
-    if processes_remaining(priority_levels) > 0:
-      for i in range(N):
-        print i, ': ', ' '.join([str((l['process_id'], l['time_received'], l['waiting_time'])) for l in priority_levels[i]])
-
-  def top_process(priority_levels):
-    if processes_remaining(priority_levels) > 0:
-      for i in range(N):
-        if len(priority_levels[i]) > 0:
-          return i, priority_levels[i][0]
-    return -1, None
-
-  def update_waiting_time(priority_levels):
-    for i in range(N):
-      for process in priority_levels[i]:
-        process['waiting_time'] += 1
-
-  while True:
-    new_processes_at_current_time = [p for p in processes if p['arrival_time'] == current_time]
-
-    if (len(new_processes_at_current_time) > 0):
-      for process in new_processes_at_current_time:
-        process['time_received'] = 0
-        priority_levels[0].append(process)
-    
-    level, current_process = top_process(priority_levels)
-    if level > -1:
-      current_process['time_received'] += 1
-      current_process['remaining_time'] -= 1
-
-      if current_process['remaining_time'] == 0:
-        priority_levels[level].pop(0) # Pop current process
-        real_times.append((current_process['process_id'], current_process['waiting_time'] + current_process['service_time']))
-      elif current_process['time_received'] == 2 ** level * T:
-        priority_levels[level].pop(0) # Pop current process
-        current_process['time_received'] = 0
-        priority_levels[level+1].append(current_process)
-      update_waiting_time(priority_levels)
-      current_process['waiting_time'] -= 1
-    
-    processes = [p for p in processes if p['arrival_time'] != current_time]
-    
-    current_time += 1
-    # print processes_remaining(priority_levels), len(processes)
-    if processes_remaining(priority_levels) == 0 and len(processes) == 0:
-      break
-    
-  print_real_times(real_times)
+  def has_ready(self):
+    return self.nonempty != 0
+
+  def push(self, level, process):
+    self.priority_levels[level].append(process)
+    self.nonempty |= 1 << level
+
+  def pop(self, level):
+    pq = self.priority_levels[level]
+    pq.popleft()
+    if not pq:
+      self.nonempty &= ~(1 << level)
+
+  def arrive(self, process):
+    self.push(0, process)
+
+  def dispatch(self):
+    level = (self.nonempty & -self.nonempty).bit_length() - 1
+    process = self.priority_levels[level][0]
+    return process, self.quantum[level] - self.time_received[process]
+
+  def preempt(self, process, run_time, remaining_time):
+    level = self.level[process]
+    self.time_received[process] += run_time
+    if self.time_received[process] == self.quantum[level]:
+      self.pop(level)
+      self.time_received[process] = 0
+      self.level[process] = min(level + 1, self.N - 1)
+      self.push(self.level[process], process)
+
+  def complete(self, process):
+    self.pop(self.level[process])
+
+def mlf(processes, N=MLF_LEVELS, T=MLF_QUANTUM, growth=MLF_GROWTH):
+  print_real_times(simulate('mlf', processes, (N, T, growth)))
+
+ALGORITHMS = OrderedDict([
+  ('fifo', FIFOScheduler),
+  ('sjf', SJFScheduler),
+  ('srt', SRTScheduler),
+  ('mlf', MLFScheduler),
+])
+
+def make_scheduler(name, processes, mlf_params=None):
+  scheduler = ALGORITHMS[name]
+  if INSTRUMENT:
+    scheduler = instrumented(scheduler)
+  if name == 'mlf':
+    return scheduler(processes, *(mlf_params or (MLF_LEVELS, MLF_QUANTUM, MLF_GROWTH)))
+  return scheduler(processes)
+
+def simulate(name, processes, mlf_params=None):
+  scheduler = make_scheduler(name, processes, mlf_params)
+  if not INSTRUMENT:
+    return run_batch(processes, scheduler)
+  start = time.time()
+  real_times = run_batch(processes, scheduler)
+  scheduler.counters['seconds'] = time.time() - start
+  instrumentation[name] = scheduler.counters
+  return real_times
+
+COUNTERS = ['dispatches', 'preemptions', 'context_switches', 'queue_inserts',
+            'queue_removes', 'demotions']
+
+def instrumented(cls):
+  # Subclass of a scheduler that counts its events. Only built when
+  # INSTRUMENT is set, so the plain schedulers carry no counting code.
+  class InstrumentedScheduler(cls):
+    def __init__(self, *args):
+      super(InstrumentedScheduler, self).__init__(*args)
+      self.counters = OrderedDict((counter, 0) for counter in COUNTERS)
+      self.last_dispatched = None
+      self.last_completed = True
+
+    def push(self, *args):
+      self.counters['queue_inserts'] += 1
+      return super(InstrumentedScheduler, self).push(*args)
+
+    def pop(self, *args):
+      self.counters['queue_removes'] += 1
+      return super(InstrumentedScheduler, self).pop(*args)
+
+    def dispatch(self):
+      # The event loop asks again at every arrival, so a process that just
+      # keeps running is not dispatched anew
+      process, time_slice = super(InstrumentedScheduler, self).dispatch()
+      if self.last_completed or process != self.last_dispatched:
+        self.counters['dispatches'] += 1
+      if self.last_dispatched is not None and process != self.last_dispatched:
+        self.counters['context_switches'] += 1
+        if not self.last_completed:
+          self.counters['preemptions'] += 1
+      self.last_dispatched = process
+      self.last_completed = False
+      return process, time_slice
+
+    def preempt(self, process, run_time, remaining_time):
+      level = getattr(self, 'level', None)
+      before = level[process] if level is not None else None
+      super(InstrumentedScheduler, self).preempt(process, run_time, remaining_time)
+      if level is not None and level[process] != before:
+        self.counters['demotions'] += 1
+
+    def complete(self, process):
+      self.last_completed = True
+      super(InstrumentedScheduler, self).complete(process)
+
+  InstrumentedScheduler.__name__ = 'Instrumented' + cls.__name__
+  return InstrumentedScheduler
+
+def write_instrumentation(name):
+  if name:
+    with open(name, 'w') as f:
+      json.dump(instrumentation, f, indent=2)
+      f.write('\n')
+
+def service_exponential(mean, rng):
+  return rng.expovariate(1.0 / mean)
+
+def service_pareto(mean, rng, alpha=1.5):
+  # Heavy tailed with finite mean: scale chosen so the mean is as requested
+  return mean * (alpha - 1) / alpha * rng.paretovariate(alpha)
+
+SERVICE_DISTRIBUTIONS = OrderedDict([
+  ('exponential', service_exponential),
+  ('pareto', service_pareto),
+])
+
+def generate_workload(num_jobs, load, distribution, mean_service, rng):
+  # Poisson arrivals at rate load / mean_service, so the offered load is
+  # load; times are rounded to whole ticks with service times of at least 1
+  service = SERVICE_DISTRIBUTIONS[distribution]
+  rate = load / mean_service
+  input_str = []
+  arrival = 0.0
+  for i in range(num_jobs):
+    arrival += rng.expovariate(rate)
+    input_str.append(int(arrival))
+    input_str.append(max(1, int(round(service(mean_service, rng)))))
+  return input_str
+
+def workload_rng(distribution, load, seed):
+  # One integer seed per workload, the same for --generate and --sweep and
+  # from one run to the next. Seeding with a string would go through
+  # hash(), which changes under PYTHONHASHSEED.
+  key = '%s-%r-%d' % (distribution, load, seed)
+  return random.Random(int(hashlib.sha1(key).hexdigest()[:16], 16))
+
+def load_workload(workload):
+  if workload[0] == 'file':
+    with open(workload[1], 'r') as f:
+      return os.path.basename(workload[1]), [int(p) for p in f.read().split()]
+  _, num_jobs, load, distribution, mean_service, seed = workload
+  name = '%s-%.2f-%d' % (distribution, load, seed)
+  rng = workload_rng(distribution, load, seed)
+  return name, generate_workload(num_jobs, load, distribution, mean_service, rng)
+
+def run_sweep_job(job):
+  # Runs in a worker process; generated workloads are rebuilt from their seed
+  # rather than shipped to the worker
+  workload, name, mlf_params = job
+  workload_name, input_str = load_workload(workload)
+  processes = ProcessTable(input_str)
+  start = time.time()
+  real_times = sorted(simulate(name, processes, mlf_params))
+  elapsed = time.time() - start
+  count = len(real_times)
+  def percentile(q):
+    return real_times[max(0, int(ceil(q * count)) - 1)] if count else 0
+  return OrderedDict([
+    ('workload', workload_name),
+    ('algorithm', name),
+    ('params', '%d:%d:%d' % mlf_params if name == 'mlf' else '-'),
+    ('jobs', count),
+    ('mean', float(sum(real_times)) / count if count else 0.0),
+    ('p50', percentile(0.5)),
+    ('p95', percentile(0.95)),
+    ('p99', percentile(0.99)),
+    ('seconds', elapsed),
+  ])
+
+def sweep(workloads, names, params, jobs=None):
+  work = []
+  for workload in workloads:
+    for name in names:
+      for mlf_params in (params if name == 'mlf' else params[:1]):
+        work.append((workload, name, mlf_params))
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(run_sweep_job, work, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def print_sweep(results, output=None):
+  # MLF params are levels:quantum:growth
+  row_format = '{0:<24} {1:<5} {2:<9} {3:>8} {4:>10.2f} {5:>8} {6:>8} {7:>8} {8:>8.3f}'
+  print '{0:<24} {1:<5} {2:<9} {3:>8} {4:>10} {5:>8} {6:>8} {7:>8} {8:>8}'.format(
+      'workload', 'alg', 'params', 'jobs', 'mean', 'p50', 'p95', 'p99', 'seconds')
+  for result in results:
+    print row_format.format(*result.values())
+  if output:
+    with open(output, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(results[0].keys() if results else [])
+      for result in results:
+        writer.writerow(result.values())
+
+class QuantileSketch(object):
+  # Log-bucketed histogram (as in DDSketch): every value in bucket i lies in
+  # (gamma ** (i-1), gamma ** i], so quantiles are within relative_accuracy
+  # of the true value while memory grows only with log(max value)
+  def __init__(self, relative_accuracy=0.01):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = log(self.gamma)
+    self.buckets = defaultdict(int)
+    self.zeros = 0
+    self.count = 0
+
+  def add(self, value):
+    self.count += 1
+    if value <= 0:
+      self.zeros += 1
+    else:
+      self.buckets[int(ceil(log(value) / self.log_gamma))] += 1
+
+  def quantile(self, q):
+    if self.count == 0:
+      return 0.0
+    # Nearest-rank definition: the smallest value with at least q of the
+    # values at or below it
+    rank = max(0, int(ceil(q * self.count)) - 1)
+    seen = self.zeros
+    if seen > rank:
+      return 0.0
+    for index in sorted(self.buckets):
+      seen += self.buckets[index]
+      if seen > rank:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+    return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+class RollingStats(object):
+  def __init__(self):
+    self.sketch = QuantileSketch()
+    self.total = 0
+    self.last_time = 0
+    self.started = time.time()
+
+  def record(self, process_id, real_time, current_time):
+    self.sketch.add(real_time)
+    self.total += real_time
+    self.last_time = current_time
+
+  def summary(self, name):
+    count = self.sketch.count
+    mean = float(self.total) / count if count else 0.0
+    throughput = float(count) / self.last_time if self.last_time else 0.0
+    elapsed = time.time() - self.started
+    return ('{0} jobs={1} mean={2:.2f} p50={3:.2f} p95={4:.2f} p99={5:.2f} '
+            'throughput={6:.4f} jobs/sec={7:.0f}').format(
+                name, count, mean, self.sketch.quantile(0.5),
+                self.sketch.quantile(0.95), self.sketch.quantile(0.99),
+                throughput, count / elapsed if elapsed > 0 else 0.0)
+
+def stream(name, processes, scheduler, report_every=0):
+  # Throughput is completed jobs per unit of simulated time
+  stats = RollingStats()
+  record = stats.record
+  if report_every > 0:
+    def record(process_id, real_time, current_time):
+      stats.record(process_id, real_time, current_time)
+      if stats.sketch.count % report_every == 0:
+        print stats.summary(name)
+  scheduler = scheduler(processes)
+  start = time.time()
+  run_events(processes, scheduler, record)
+  if INSTRUMENT:
+    scheduler.counters['seconds'] = time.time() - start
+    instrumentation[name] = scheduler.counters
+  # Unless a periodic report already covered the last job
+  count = stats.sketch.count
+  if report_every <= 0 or count == 0 or count % report_every:
+    print stats.summary(name)
 
 if __name__ == "__main__":
   main()
@@ -1,21 +1,62 @@
 #!/bin/python
 
+import argparse
+import contextlib
+import heapq
+import mmap
+import os
 import pickle
+import shutil
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import timeit
+import zlib
 
 DEBUG = False
 DISK_DIR = './disk/'
+# Default disk geometry
 NUM_BLOCKS_IN_DISK = 64
 NUM_BYTES_IN_BLOCK = 64
+NUM_DESCRIPTOR_BLOCKS = 6
+NUM_DIRECTORY_BLOCKS = 3
 NUM_BYTES_IN_INT = 4
-NUM_DESCRIPTORS_IN_BLOCK = 4
+# File length followed by three block pointers
+NUM_INTS_IN_DESCRIPTOR = 4
+NUM_INTS_IN_DIRECTORY_ENTRY = 2
 NUM_BITS_IN_BYTE = 8
 NUM_ENTRIES_IN_OFT = 4
+# Data bytes that have never been written
+EMPTY_BYTE = '\x00'
+INT_FORMAT = '<i'
+WORD_FORMAT = '<Q'
+NUM_BITS_IN_WORD = 64
+FULL_WORD = (1 << NUM_BITS_IN_WORD) - 1
+FULL_BYTE = '\xff'
+CACHE_BLOCKS = 16
+# Geometry recorded after the last block of the image: magic, number of
+# blocks, block size, descriptor blocks, directory blocks and whether
+# descriptors use indirect blocks
+SUPERBLOCK_MAGIC = 'CSFS'
+SUPERBLOCK_FORMAT = '<4s5i'
+SUPERBLOCK_SIZE = struct.calcsize(SUPERBLOCK_FORMAT)
+# A save journal is a header of magic, block size and block count, then
+# each block number and its contents, then a commit record of magic and
+# the CRC-32 of everything before it
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = 'JRNL'
+JOURNAL_HEADER_FORMAT = '<4s2i'
+JOURNAL_COMMIT_MAGIC = 'DONE'
+JOURNAL_COMMIT_FORMAT = '<4sI'
 
 def convert_filename_to_int(name):
   result = 0
   for char in name:
     result <<= NUM_BITS_IN_BYTE
-    result |= ord(char) 
+    result |= ord(char)
   return result
 
 def convert_int_to_filename(num):
@@ -25,9 +66,13 @@ def convert_int_to_filename(num):
     num >>= NUM_BITS_IN_BYTE
   return filename
 
-def print_blocks(blocks):
-  for i in range(18):
-    print i, ':', blocks[i]
+def print_blocks(disk):
+  geometry = disk.geometry
+  for i in range(geometry.first_data_block + 8):
+    if geometry.bitmap_blocks <= i < geometry.first_data_block:
+      print i, ':', list(disk.read_ints(i))
+    else:
+      print i, ':', repr(disk.block_bytes(i))
 
 class FSError(Exception):
   def __init__(self, value):
@@ -35,170 +80,790 @@ class FSError(Exception):
   def __str__(self):
     return repr(self.value)
 
+class Bitmap(object):
+  # Free-space bitmap packed at the start of the disk image: bit i % 8 of
+  # byte i // 8 is set while block i is in use. Scans read 64-bit words and
+  # start from the word the last allocation came from.
+  def __init__(self, image, num_blocks):
+    self.image = image
+    self.num_blocks = num_blocks
+    self.num_words = (num_blocks + NUM_BITS_IN_WORD - 1) // NUM_BITS_IN_WORD
+    self.next_free_word = 0
+
+  def format(self, reserved):
+    # Padding bits past the last block count as used so they are never found
+    reserved = min(reserved, self.num_blocks)
+    self.set_range(0, reserved, True)
+    self.set_range(reserved, self.num_blocks, False)
+    self.set_range(self.num_blocks, self.num_words * NUM_BITS_IN_WORD, True)
+
+  def set_range(self, start, end, used):
+    # Bits start to end, a bit at a time up to the first and from the last
+    # byte boundary and whole bytes in between
+    first = min(end, -(-start // NUM_BITS_IN_BYTE) * NUM_BITS_IN_BYTE)
+    last = max(first, end // NUM_BITS_IN_BYTE * NUM_BITS_IN_BYTE)
+    for i in range(start, first):
+      self.set(i, used)
+    self.image[first // NUM_BITS_IN_BYTE:last // NUM_BITS_IN_BYTE] = (
+        (FULL_BYTE if used else EMPTY_BYTE) * ((last - first) // NUM_BITS_IN_BYTE))
+    for i in range(last, end):
+      self.set(i, used)
+
+  def get(self, index):
+    return (self.image[index // NUM_BITS_IN_BYTE] >> (index % NUM_BITS_IN_BYTE)) & 1
+
+  def set(self, index, used):
+    if used:
+      self.image[index // NUM_BITS_IN_BYTE] |= 1 << (index % NUM_BITS_IN_BYTE)
+    else:
+      self.image[index // NUM_BITS_IN_BYTE] &= ~(1 << (index % NUM_BITS_IN_BYTE))
+
+  def allocate(self, count=1):
+    # Marks and returns count free blocks, taking every free bit of a word
+    # before moving on to the next one
+    blocks = []
+    word = self.next_free_word
+    scanned = 0
+    while scanned <= self.num_words:
+      scanned += 1
+      offset = word * NUM_BITS_IN_WORD // NUM_BITS_IN_BYTE
+      value = struct.unpack_from(WORD_FORMAT, self.image, offset)[0]
+      free = ~value & FULL_WORD
+      if free:
+        while free and len(blocks) < count:
+          bit = free & -free
+          free ^= bit
+          value |= bit
+          blocks.append(word * NUM_BITS_IN_WORD + bit.bit_length() - 1)
+        struct.pack_into(WORD_FORMAT, self.image, offset, value)
+        if len(blocks) == count:
+          self.next_free_word = word
+          return blocks
+      word = (word + 1) % self.num_words
+    self.free(blocks)
+    raise FSError('Disk is full!')
+
+  def free(self, blocks):
+    for index in blocks:
+      self.set(index, False)
+
+class Geometry(object):
+  # Layout of a disk: the bitmap blocks, then the descriptor blocks, then
+  # the directory blocks, then data blocks. A descriptor is a file length
+  # followed by block pointers. An indexed disk keeps one direct pointer
+  # and turns the other two into a single and a double indirect pointer,
+  # each naming a block full of pointers.
+  def __init__(self, num_blocks=NUM_BLOCKS_IN_DISK, block_size=NUM_BYTES_IN_BLOCK,
+               descriptor_blocks=NUM_DESCRIPTOR_BLOCKS,
+               directory_blocks=NUM_DIRECTORY_BLOCKS, indexed=0):
+    try:
+      self.num_blocks = int(num_blocks)
+      self.block_size = int(block_size)
+      self.descriptor_blocks = int(descriptor_blocks)
+      self.directory_blocks = int(directory_blocks)
+      self.indexed = int(indexed)
+    except ValueError:
+      raise FSError('Invalid disk geometry!')
+    if (self.block_size % NUM_BYTES_IN_INT or
+        self.block_size < NUM_INTS_IN_DESCRIPTOR * NUM_BYTES_IN_INT or
+        self.descriptor_blocks < 1 or self.directory_blocks < 1 or
+        self.indexed not in (0, 1)):
+      raise FSError('Invalid disk geometry!')
+
+    self.ints_in_block = self.block_size // NUM_BYTES_IN_INT
+    self.ints_format = '<%di' % self.ints_in_block
+    self.descriptors_in_block = self.ints_in_block // NUM_INTS_IN_DESCRIPTOR
+    self.entries_in_directory_block = self.ints_in_block // NUM_INTS_IN_DIRECTORY_ENTRY
+    num_words = (self.num_blocks + NUM_BITS_IN_WORD - 1) // NUM_BITS_IN_WORD
+    bitmap_bytes = num_words * NUM_BITS_IN_WORD // NUM_BITS_IN_BYTE
+    self.bitmap_blocks = (bitmap_bytes + self.block_size - 1) // self.block_size
+    self.first_descriptor_block = self.bitmap_blocks
+    self.first_directory_block = self.first_descriptor_block + self.descriptor_blocks
+    self.first_data_block = self.first_directory_block + self.directory_blocks
+    if self.first_data_block >= self.num_blocks:
+      raise FSError('Invalid disk geometry!')
+
+    pointers = NUM_INTS_IN_DESCRIPTOR - 1
+    self.direct_pointers = pointers - 2 if self.indexed else pointers
+    self.max_file_blocks = self.direct_pointers
+    if self.indexed:
+      self.max_file_blocks += self.ints_in_block + self.ints_in_block ** 2
+    self.max_file_size = self.max_file_blocks * self.block_size
+
+  def pack(self):
+    return struct.pack(SUPERBLOCK_FORMAT, SUPERBLOCK_MAGIC, self.num_blocks,
+                       self.block_size, self.descriptor_blocks,
+                       self.directory_blocks, self.indexed)
+
+def read_superblock(image):
+  # Images saved before the superblock existed have the default geometry
+  if len(image) > SUPERBLOCK_SIZE:
+    fields = struct.unpack_from(SUPERBLOCK_FORMAT, image, len(image) - SUPERBLOCK_SIZE)
+    if fields[0] == SUPERBLOCK_MAGIC:
+      geometry = Geometry(*fields[1:])
+      if len(image) == geometry.num_blocks * geometry.block_size + SUPERBLOCK_SIZE:
+        return geometry
+  return None
+
+def migrate_image(image):
+  # Older saves are pickles of either the original list of blocks, holding
+  # one bitmap int per block, ints and None or a char per data byte, or of
+  # a bytearray image. The first bytearray images also kept one bitmap byte
+  # per block, and as blocks 0-7 are always in use that is told apart from
+  # a packed bitmap by its first byte being 1.
+  if isinstance(image, list):
+    flags = image[0]
+    migrated = bytearray()
+    for num, block in enumerate(image[1:], 1):
+      if num < 1 + NUM_DESCRIPTOR_BLOCKS + NUM_DIRECTORY_BLOCKS:
+        migrated += struct.pack('<%di' % len(block), *block)
+      else:
+        migrated += ''.join((byte or EMPTY_BYTE)[0] for byte in block)
+    image = bytearray(NUM_BYTES_IN_BLOCK) + migrated
+  else:
+    image = bytearray(image)
+    if read_superblock(image) is not None or image[0] != 1:
+      return image
+    flags = list(image[:NUM_BLOCKS_IN_DISK])
+    image[:NUM_BYTES_IN_BLOCK] = bytearray(NUM_BYTES_IN_BLOCK)
+
+  bitmap = Bitmap(image, NUM_BLOCKS_IN_DISK)
+  for index, used in enumerate(flags[:NUM_BLOCKS_IN_DISK]):
+    bitmap.set(index, used)
+  return image
+
+def pwrite(fd, data, offset):
+  # os.pwrite only exists from Python 3.3 on
+  if hasattr(os, 'pwrite'):
+    return os.pwrite(fd, data, offset)
+  os.lseek(fd, offset, os.SEEK_SET)
+  return os.write(fd, data)
+
+def write_journal(path, block_size, blocks):
+  journal = struct.pack(JOURNAL_HEADER_FORMAT, JOURNAL_MAGIC, block_size, len(blocks))
+  journal += ''.join(struct.pack(INT_FORMAT, num) + block for num, block in blocks)
+  journal += struct.pack(JOURNAL_COMMIT_FORMAT, JOURNAL_COMMIT_MAGIC,
+                         zlib.crc32(journal) & 0xffffffff)
+  fd = os.open(path + JOURNAL_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+  try:
+    os.write(fd, journal)
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def read_journal(journal):
+  # Returns the block size and blocks of a committed journal, or None for
+  # one that was cut short
+  header_size = struct.calcsize(JOURNAL_HEADER_FORMAT)
+  commit_size = struct.calcsize(JOURNAL_COMMIT_FORMAT)
+  if len(journal) < header_size + commit_size:
+    return None
+  magic, crc = struct.unpack_from(JOURNAL_COMMIT_FORMAT, journal, len(journal) - commit_size)
+  body = journal[:-commit_size]
+  if magic != JOURNAL_COMMIT_MAGIC or zlib.crc32(body) & 0xffffffff != crc:
+    return None
+  magic, block_size, count = struct.unpack_from(JOURNAL_HEADER_FORMAT, body)
+  entry_size = NUM_BYTES_IN_INT + block_size
+  if magic != JOURNAL_MAGIC or len(body) != header_size + count * entry_size:
+    return None
+  blocks = []
+  for i in range(count):
+    offset = header_size + i * entry_size
+    num, = struct.unpack_from(INT_FORMAT, body, offset)
+    blocks.append((num, body[offset+NUM_BYTES_IN_INT:offset+entry_size]))
+  return block_size, blocks
+
+def recover_journal(path):
+  # Replays a committed journal left behind by a save that was cut short.
+  # A journal that was itself cut short is dropped, since the image was
+  # not touched until the journal was complete.
+  try:
+    with open(path + JOURNAL_SUFFIX, 'rb') as f:
+      journal = read_journal(f.read())
+  except IOError:
+    return
+  if journal is not None and os.path.exists(path):
+    block_size, blocks = journal
+    fd = os.open(path, os.O_WRONLY)
+    try:
+      for num, block in blocks:
+        pwrite(fd, block, num * block_size)
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+  os.remove(path + JOURNAL_SUFFIX)
+
+def load_image(path):
+  # Returns the image and whether the file holds it raw, as opposed to an
+  # older pickle that has to be migrated. A raw image is mapped copy on
+  # write rather than read, so a block is only read in from the file when
+  # first touched and changes stay private to the process until saved.
+  recover_journal(path)
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size > SUPERBLOCK_SIZE:
+      image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+      if read_superblock(image) is not None:
+        return image, True
+      image.close()
+    data = f.read()
+  try:
+    return migrate_image(pickle.loads(data)), False
+  except Exception:
+    raise FSError('Unrecognized disk image!')
+
 class Disk(object):
-  def __init__(self, name, blocks=[]):
+  # The whole disk is one image holding the blocks followed by the
+  # superblock, saved to file as is: a bytearray, or an mmap of a restored
+  # raw image. The bitmap blocks come first and the descriptor and
+  # directory blocks hold little-endian ints, data blocks raw bytes.
+  # read_block returns a memoryview onto a bytearray image, so it is
+  # zero-copy, and a slice of a mapped one. Only write_block and write_int
+  # mark a block dirty for the next save.
+  def __init__(self, name, image=None, geometry=None, path=None):
     self.name = name
-    self.blocks = blocks
-
-    if blocks == []:
-      # Init bitmap
-      self.blocks.append([])
-      for i in range(NUM_BYTES_IN_BLOCK):
-        self.blocks[0].append(0)
-      for i in range(10):
-        # Block   0 - bitmap
-        # Block 1-6 - file descriptors
-        # Block 7-9 - directory
-        self.blocks[0][i] = 1
-
-      for i in range(1, 10):
-        block = []
-        for j in range(NUM_BYTES_IN_BLOCK/NUM_BYTES_IN_INT):
-          block.append(-1)
-        self.blocks.append(block)
-
-      for i in range(10, NUM_BLOCKS_IN_DISK):
-        block = []
-        for j in range(NUM_BYTES_IN_BLOCK):
-          block.append(None)
-        self.blocks.append(block)
-
-      # Slot 0 - Directory
-      self.blocks[1][0] = 0
-      self.blocks[1][1] = 7
-      self.blocks[1][2] = 8
-      self.blocks[1][3] = 9
+    # File the image was last loaded from or saved to raw, and the blocks
+    # written since
+    self.path = path
+    self.dirty = set()
+
+    if image is None:
+      self.geometry = geometry = geometry or Geometry()
+      self.block_size = geometry.block_size
+      self.image = bytearray(geometry.num_blocks * geometry.block_size)
+      self.image += geometry.pack()
+      Bitmap(self.image, geometry.num_blocks).format(geometry.first_data_block)
+      for i in range(geometry.first_descriptor_block, geometry.first_data_block):
+        self.write_block(i, struct.pack(geometry.ints_format,
+                                        *([-1] * geometry.ints_in_block)))
+
+      # Slot 0 - Directory, pointing at as many directory blocks as it can
+      self.write_int(geometry.first_descriptor_block, 0, 0)
+      for i in range(min(geometry.direct_pointers, geometry.directory_blocks)):
+        self.write_int(geometry.first_descriptor_block, i + 1,
+                       geometry.first_directory_block + i)
+    else:
+      self.image = image if isinstance(image, mmap.mmap) else bytearray(image)
+      self.geometry = read_superblock(self.image)
+      if self.geometry is None:
+        self.geometry = Geometry()
+        self.image += self.geometry.pack()
+      self.block_size = self.geometry.block_size
+    # Python 2 cannot take a memoryview of an mmap
+    self.view = self.image if isinstance(self.image, mmap.mmap) else memoryview(self.image)
+    self.bitmap = Bitmap(self.image, self.geometry.num_blocks)
 
   def read_block(self, num):
-    return self.blocks[num]
+    return self.view[num*self.block_size:(num+1)*self.block_size]
+
+  def block_bytes(self, num):
+    return bytes(self.image[num*self.block_size:(num+1)*self.block_size])
 
   def write_block(self, num, block):
-    self.blocks[num] = block
+    # An mmap only takes str slices
+    self.image[num*self.block_size:(num+1)*self.block_size] = bytes(block)
+    self.dirty.add(num)
+
+  def read_int(self, num, index):
+    return struct.unpack_from(INT_FORMAT, self.image,
+                              num*self.block_size + index*NUM_BYTES_IN_INT)[0]
+
+  def write_int(self, num, index, value):
+    struct.pack_into(INT_FORMAT, self.image,
+                     num*self.block_size + index*NUM_BYTES_IN_INT, value)
+    self.dirty.add(num)
+
+  def read_ints(self, num):
+    return struct.unpack_from(self.geometry.ints_format, self.image, num*self.block_size)
+
+  def data_length(self, num, start=0):
+    # Length of the block's written prefix, scanning from start onwards
+    end = self.image.find(EMPTY_BYTE, num*self.block_size + start,
+                          (num+1)*self.block_size)
+    return self.block_size if end == -1 else end - num*self.block_size
 
   def save_disk(self, name):
-    f = open(DISK_DIR + name, 'w+')
-    f.write(pickle.dumps(self.blocks))
-    f.close()
+    path = DISK_DIR + name
+    if path == self.path and os.path.exists(path) and os.path.getsize(path) == len(self.image):
+      # Only the dirty blocks are written, in place. They are journalled
+      # first so a save cut short can be replayed on the next load.
+      blocks = [(num, self.block_bytes(num)) for num in sorted(self.dirty)]
+      if blocks:
+        write_journal(path, self.block_size, blocks)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+          for num, block in blocks:
+            pwrite(fd, block, num * self.block_size)
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+        os.remove(path + JOURNAL_SUFFIX)
+    else:
+      # A new file gets the whole image, renamed into place once written
+      with open(path + '.tmp', 'wb') as f:
+        f.write(self.image)
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(path + '.tmp', path)
+      self.path = path
+    self.dirty.clear()
+
+class BlockCache(object):
+  # Write-back cache of disk blocks sitting between the FileSystem and the
+  # Disk. Blocks are copied in on a miss and written back when dirty on
+  # eviction or flush. Cached blocks are kept in a circular doubly linked
+  # list from least to most recently used, so a hit moves its block to the
+  # end and a miss on a full cache evicts from the front, both in constant
+  # time. Nodes are [prev, next, num, block] lists.
+  # The bitmap blocks are held apart so they are never evicted. Block
+  # access is serialized by one lock and allocation by another; code
+  # needing both takes the allocator lock first.
+  def __init__(self, disk, capacity=CACHE_BLOCKS):
+    self.disk = disk
+    self.geometry = disk.geometry
+    self.lock = threading.Lock()
+    self.allocator_lock = threading.Lock()
+    self.capacity = max(1, capacity)
+    self.blocks = {}
+    self.root = root = []
+    root[:] = [root, root, None, None]
+    self.dirty = set()
+    self.bitmap_blocks = bytearray(disk.image[:self.geometry.bitmap_blocks * disk.block_size])
+    self.bitmap = Bitmap(self.bitmap_blocks, self.geometry.num_blocks)
+    self.bitmap.next_free_word = disk.bitmap.next_free_word
+    self.bitmap_dirty = False
+    self.hits = 0
+    self.misses = 0
+    self.flushes = 0
+
+  def get(self, num):
+    root = self.root
+    node = self.blocks.get(num)
+    if node is None:
+      self.misses += 1
+      if len(self.blocks) >= self.capacity:
+        victim = root[1]
+        root[1] = victim[1]
+        victim[1][0] = root
+        del self.blocks[victim[2]]
+        if victim[2] in self.dirty:
+          self.write_back(victim[2], victim[3])
+      last = root[0]
+      node = last[1] = root[0] = self.blocks[num] = [last, root, num, bytearray(self.disk.read_block(num))]
+    else:
+      self.hits += 1
+      last = root[0]
+      if node is not last:
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
+    return node[3]
+
+  def write_back(self, num, block):
+    self.disk.write_block(num, block)
+    self.dirty.discard(num)
+    self.flushes += 1
+
+  def flush(self):
+    with self.allocator_lock:
+      with self.lock:
+        self.flush_dirty()
 
-class FileSystem(object):
+  def save_disk(self, name):
+    with self.allocator_lock:
+      with self.lock:
+        self.flush_dirty()
+        self.disk.save_disk(name)
+
+  def flush_dirty(self):
+    for num in sorted(self.dirty):
+      self.write_back(num, self.blocks[num][3])
+    if self.bitmap_dirty:
+      block_size = self.disk.block_size
+      for i in range(self.geometry.bitmap_blocks):
+        self.disk.write_block(i, self.bitmap_blocks[i*block_size:(i+1)*block_size])
+        self.flushes += 1
+      self.bitmap_dirty = False
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'flushes': self.flushes}
+
+  def allocate(self, count=1):
+    with self.allocator_lock:
+      blocks = self.bitmap.allocate(count)
+      self.bitmap_dirty = True
+      return blocks
+
+  def free(self, blocks):
+    with self.allocator_lock:
+      self.bitmap.free(blocks)
+      self.bitmap_dirty = True
+
+  def read_block(self, num):
+    with self.lock:
+      return memoryview(self.get(num))
+
+  def write_block(self, num, block):
+    with self.lock:
+      self.get(num)[:] = block
+      self.dirty.add(num)
+
+  def write_span(self, num, start, data):
+    with self.lock:
+      self.get(num)[start:start+len(data)] = data
+      self.dirty.add(num)
+
+  def read_int(self, num, index):
+    with self.lock:
+      return struct.unpack_from(INT_FORMAT, self.get(num), index*NUM_BYTES_IN_INT)[0]
+
+  def write_int(self, num, index, value):
+    with self.lock:
+      struct.pack_into(INT_FORMAT, self.get(num), index*NUM_BYTES_IN_INT, value)
+      self.dirty.add(num)
+
+  def read_ints(self, num):
+    with self.lock:
+      return struct.unpack_from(self.geometry.ints_format, self.get(num))
+
+  def data_length(self, num, start=0):
+    with self.lock:
+      end = self.get(num).find(EMPTY_BYTE, start)
+      return self.disk.block_size if end == -1 else end
+
+class RWLock(object):
+  # Any number of readers or one writer. A waiting writer holds off new
+  # readers so a steady stream of them cannot starve it. Waiters are only
+  # woken when there are any, as the wake up is slow.
   def __init__(self):
+    self.condition = threading.Condition(threading.Lock())
+    self.readers = 0
+    self.writer = False
+    self.readers_waiting = 0
+    self.writers_waiting = 0
+
+  def acquire_read(self):
+    with self.condition:
+      while self.writer or self.writers_waiting:
+        self.readers_waiting += 1
+        self.condition.wait()
+        self.readers_waiting -= 1
+      self.readers += 1
+
+  def release_read(self):
+    with self.condition:
+      self.readers -= 1
+      if not self.readers and self.writers_waiting:
+        self.condition.notify_all()
+
+  def acquire_write(self):
+    with self.condition:
+      while self.writer or self.readers:
+        self.writers_waiting += 1
+        self.condition.wait()
+        self.writers_waiting -= 1
+      self.writer = True
+
+  def release_write(self):
+    with self.condition:
+      self.writer = False
+      if self.readers_waiting or self.writers_waiting:
+        self.condition.notify_all()
+
+  @contextlib.contextmanager
+  def reading(self):
+    self.acquire_read()
+    try:
+      yield
+    finally:
+      self.release_read()
+
+  @contextlib.contextmanager
+  def writing(self):
+    self.acquire_write()
+    try:
+      yield
+    finally:
+      self.release_write()
+
+class FileSystem(object):
+  # Safe to share between threads. The directory index, the OFT and the
+  # set of open files are guarded by one lock, each file's data and length
+  # by a reader/writer lock on its descriptor, and the cache has its own
+  # block and allocator locks. Locks are taken in that order. The buffer
+  # and position in OFT entries have a lock of their own that is never
+  # held while taking another.
+  def __init__(self, cache_blocks=CACHE_BLOCKS, max_open_files=NUM_ENTRIES_IN_OFT):
     self.current_disk = None
+    self.geometry = None
+    self.cache = None
+    self.cache_blocks = cache_blocks
+    self.lock = threading.RLock()
+    self.descriptor_locks = {}
+    self.entry_lock = threading.Lock()
     self.open_files = set()
-    # Dict of oft_index: [rw_buffer, curr_pos, fd_index]
+    # Dict of oft_index: [rw_buffer, curr_pos, fd_index, name, buffer_block].
+    # Closed indices are reused lowest first, and past that the table grows
+    # up to max_open_files entries, or without limit if that is None.
     self.OFT = {}
+    self.max_open_files = max_open_files
+    self.free_OFT_entries = []
+    self.next_OFT_entry = 1
+    # In-memory index of the directory blocks: dict of filename int:
+    # (fd_index, slot), plus min-heaps of free directory slots and free
+    # descriptors so the lowest one is reused first, as a scan would
+    self.directory = {}
+    self.free_slots = []
+    self.free_descriptors = []
+
+  def build_directory_index(self):
+    geometry = self.geometry
+    self.directory = {}
+    self.free_slots = []
+    for n in range(geometry.directory_blocks):
+      block_data = self.cache.read_ints(geometry.first_directory_block + n)
+      for i in range(geometry.entries_in_directory_block):
+        slot = n * geometry.entries_in_directory_block + i
+        if block_data[i*NUM_INTS_IN_DIRECTORY_ENTRY] == -1:
+          self.free_slots.append(slot)
+        else:
+          self.directory[block_data[i*NUM_INTS_IN_DIRECTORY_ENTRY]] = \
+              (block_data[i*NUM_INTS_IN_DIRECTORY_ENTRY+1], slot)
+
+    self.free_descriptors = []
+    for n in range(geometry.descriptor_blocks):
+      block_data = self.cache.read_ints(geometry.first_descriptor_block + n)
+      for i in range(geometry.descriptors_in_block):
+        if block_data[i*NUM_INTS_IN_DESCRIPTOR] == -1:
+          self.free_descriptors.append(n * geometry.descriptors_in_block + i)
+
+  def descriptor_position(self, fd_index):
+    # Block and int index of a file descriptor
+    geometry = self.geometry
+    return (geometry.first_descriptor_block + fd_index // geometry.descriptors_in_block,
+            fd_index % geometry.descriptors_in_block * NUM_INTS_IN_DESCRIPTOR)
+
+  def directory_position(self, slot):
+    # Block and int index of a directory entry
+    geometry = self.geometry
+    return (geometry.first_directory_block + slot // geometry.entries_in_directory_block,
+            slot % geometry.entries_in_directory_block * NUM_INTS_IN_DIRECTORY_ENTRY)
+
+  def indirect_block(self, block_num, index, allocate):
+    pointer = self.cache.read_int(block_num, index)
+    if pointer == -1:
+      if not allocate:
+        return None
+      pointer, = self.allocate_blocks()
+      self.cache.write_block(pointer, struct.pack(self.geometry.ints_format,
+                                                  *([-1] * self.geometry.ints_in_block)))
+      self.cache.write_int(block_num, index, pointer)
+    return pointer
+
+  def pointer_position(self, fd_index, file_block, allocate=False):
+    # Block and int index of the pointer to a block of the file: in the
+    # descriptor for a direct block, else in an indirect block. Missing
+    # indirect blocks are allocated if asked for and otherwise give None.
+    geometry = self.geometry
+    block_num, index = self.descriptor_position(fd_index)
+    if file_block < geometry.direct_pointers:
+      return block_num, index + 1 + file_block
+    elif file_block >= geometry.max_file_blocks:
+      return None
+
+    file_block -= geometry.direct_pointers
+    index += 1 + geometry.direct_pointers
+    if file_block < geometry.ints_in_block:
+      block_num = self.indirect_block(block_num, index, allocate)
+    else:
+      file_block -= geometry.ints_in_block
+      block_num = self.indirect_block(block_num, index + 1, allocate)
+      if block_num is not None:
+        block_num = self.indirect_block(block_num, file_block // geometry.ints_in_block, allocate)
+      file_block %= geometry.ints_in_block
+    return None if block_num is None else (block_num, file_block)
+
+  def get_file_block(self, fd_index, file_block):
+    position = self.pointer_position(fd_index, file_block)
+    return self.cache.read_int(*position) if position else -1
+
+  def set_file_blocks(self, fd_index, file_blocks):
+    # The data blocks are allocated in one go, and any indirect blocks as
+    # they are first needed. Data blocks left over when the disk fills up
+    # are handed back.
+    disk_blocks = self.allocate_blocks(len(file_blocks))
+    for n, file_block in enumerate(file_blocks):
+      try:
+        block_num, index = self.pointer_position(fd_index, file_block, True)
+      except FSError:
+        self.free_blocks(disk_blocks[n:])
+        raise
+      self.cache.write_int(block_num, index, disk_blocks[n])
+
+  def file_blocks(self, fd_index):
+    # Every block the file holds, data and indirect alike
+    geometry = self.geometry
+    block_num, index = self.descriptor_position(fd_index)
+    pointers = self.cache.read_ints(block_num)[index+1:index+NUM_INTS_IN_DESCRIPTOR]
+    blocks = [b for b in pointers[:geometry.direct_pointers] if b > -1]
+    if geometry.indexed:
+      single, double = pointers[geometry.direct_pointers:]
+      indirect = [single] if single > -1 else []
+      if double > -1:
+        blocks.append(double)
+        indirect.extend(b for b in self.cache.read_ints(double) if b > -1)
+      for indirect_block in indirect:
+        blocks.append(indirect_block)
+        blocks.extend(b for b in self.cache.read_ints(indirect_block) if b > -1)
+    return blocks
 
   def retrieve_file(self, name):
     if not self.current_disk:
       raise FSError('Disk not initialized!')
-    num = convert_filename_to_int(name)
-    for block_num in range(7, 10):
-      block_data = self.current_disk.read_block(block_num)
-      for i in range(len(block_data)/2):
-        if block_data[i*2] == num:
-          return block_data[i*2+1]
-    return -1
+    entry = self.directory.get(convert_filename_to_int(name))
+    return entry[0] if entry else -1
 
   def remove_directory_entry(self, name):
     if not self.current_disk:
       raise FSError('Disk not initialized!')
-    num = convert_filename_to_int(name)
-    for block_num in range(7, 10):
-      block_data = self.current_disk.read_block(block_num)
-      for i in range(len(block_data)/2):
-        if block_data[i*2] == num:
-          block_data[i*2] = -1
-          block_data[i*2+1] = -1
-          self.current_disk.write_block(block_num, block_data)
-          return
-
-  def find_empty_block(self):
-    bitmap = self.current_disk.read_block(0)
-    for i in range(NUM_BLOCKS_IN_DISK):
-      if bitmap[i] == 0:
-        return i
-    return -1
+    entry = self.directory.pop(convert_filename_to_int(name), None)
+    if entry:
+      slot = entry[1]
+      block_num, index = self.directory_position(slot)
+      self.cache.write_int(block_num, index, -1)
+      self.cache.write_int(block_num, index+1, -1)
+      heapq.heappush(self.free_slots, slot)
+
+  def allocate_blocks(self, count=1):
+    return self.cache.allocate(count)
+
+  def free_blocks(self, blocks):
+    self.cache.free(blocks)
 
   def get_OFT_free_entry(self):
-    for i in range(1, NUM_ENTRIES_IN_OFT):
-      if i not in self.OFT:
-        return i
-    raise FSError('No more free entries in OFT!')
+    if self.free_OFT_entries:
+      return heapq.heappop(self.free_OFT_entries)
+    elif self.max_open_files is not None and self.next_OFT_entry >= self.max_open_files:
+      raise FSError('No more free entries in OFT!')
+    self.next_OFT_entry += 1
+    return self.next_OFT_entry - 1
+
+  def reset_OFT(self, entries):
+    self.OFT = entries
+    self.open_files = set()
+    self.free_OFT_entries = []
+    self.next_OFT_entry = 1
+
+  def descriptor_lock(self, fd_index):
+    with self.lock:
+      lock = self.descriptor_locks.get(fd_index)
+      if lock is None:
+        lock = self.descriptor_locks[fd_index] = RWLock()
+      return lock
+
+  @contextlib.contextmanager
+  def locked_entry(self, oft_index, shared):
+    # Holds the descriptor lock of an OFT entry's file, shared or not, and
+    # yields the entry. It is looked up again once the lock is held in case
+    # the file was closed while waiting.
+    with self.lock:
+      entry = self.OFT.get(oft_index)
+      if entry is None:
+        raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
+      lock = self.descriptor_lock(entry[2])
+    if shared:
+      lock.acquire_read()
+    else:
+      lock.acquire_write()
+    try:
+      if self.OFT.get(oft_index) is not entry:
+        raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
+      yield entry
+    finally:
+      if shared:
+        lock.release_read()
+      else:
+        lock.release_write()
+
+  # Readers of a file share its OFT entry, so they take and store its
+  # buffer and position as a whole
+  def entry_state(self, entry):
+    with self.entry_lock:
+      return list(entry)
 
-  def set_bitmap_value(self, index, value):
-    bitmap = self.current_disk.read_block(0)
-    bitmap[index] = value
-    self.current_disk.write_block(0, bitmap)
+  def set_entry_state(self, entry, state):
+    with self.entry_lock:
+      entry[:] = state
 
   def create_file(self, name):
+    with self.lock:
+      return self.create_entry(name)
+
+  def create_entry(self, name):
     fd_index = self.retrieve_file(name)
     if fd_index >= 0:
       raise FSError('File already exists!')
+    elif convert_filename_to_int(name) >= 1 << (NUM_BYTES_IN_INT * NUM_BITS_IN_BYTE - 1):
+      raise FSError('File name "' + name + '" is too long!')
+    elif not self.free_descriptors:
+      raise FSError('No more free file descriptors!')
+    elif not self.free_slots:
+      raise FSError('Directory is full!')
     else:
-      # Find a free file descriptor
-      descriptor_index = -1
-      for num in range(6):
-        block_num = num + 1
-        block_data = self.current_disk.read_block(block_num)
-        for i in range(NUM_DESCRIPTORS_IN_BLOCK):
-          if block_data[i*NUM_DESCRIPTORS_IN_BLOCK] == -1:
-            descriptor_index = num * NUM_DESCRIPTORS_IN_BLOCK + i
-            # Update file descriptor
-            block_data[i*NUM_DESCRIPTORS_IN_BLOCK] = 0
-            self.current_disk.write_block(block_num, block_data)
-            break
-        if descriptor_index != -1:
-          break
-
-      # Find a free directory entry
-      free_directory_found = False
-      for block_num in range(7, 10):
-        block_data = self.current_disk.read_block(block_num)
-        for i in range(len(block_data)/2):
-          if block_data[i*2] == -1:
-            block_data[i*2] = convert_filename_to_int(name)
-            block_data[i*2+1] = descriptor_index
-            self.current_disk.write_block(block_num, block_data)
-            free_directory_found = True
-            break
-        if free_directory_found:
-          break
+      # Take the lowest free file descriptor
+      descriptor_index = heapq.heappop(self.free_descriptors)
+      block_num, index = self.descriptor_position(descriptor_index)
+      self.cache.write_int(block_num, index, 0)
+
+      # Take the lowest free directory entry
+      slot = heapq.heappop(self.free_slots)
+      block_num, index = self.directory_position(slot)
+      num = convert_filename_to_int(name)
+      self.cache.write_int(block_num, index, num)
+      self.cache.write_int(block_num, index+1, descriptor_index)
+      self.directory[num] = (descriptor_index, slot)
 
       return name + ' created'
 
   def destroy_file(self, name):
-    # Search directory to find file descriptor
-    fd_index = self.retrieve_file(name)
-    if fd_index < 0:
-      raise FSError('File "' + name + '" does not exist!')
-    else:
-      # Remove from OFT table if file is open
-      for i in range(1, NUM_ENTRIES_IN_OFT):
-        if i in self.OFT and self.OFT[i][2] == fd_index:
-          self.close_file(i)
-
-      # Remove directory entry
-      self.remove_directory_entry(name)
-
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      
-      # Update bit map
-      for i in range(1, NUM_DESCRIPTORS_IN_BLOCK):
-        if i > 0 and block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i] > -1:
-          self.set_bitmap_value(block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i], 0)
-
-      # Free file descriptor
-      block_data[index*NUM_DESCRIPTORS_IN_BLOCK] = -1
-      for i in range(1, NUM_DESCRIPTORS_IN_BLOCK):
-        disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i]
-        block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i] = -1
-        self.current_disk.write_block(disk_block_num, [None] * NUM_BYTES_IN_BLOCK)
-      self.current_disk.write_block(block_num, block_data)
-
-      return name + ' destroyed'
+    with self.lock:
+      # Search directory to find file descriptor
+      fd_index = self.retrieve_file(name)
+      if fd_index < 0:
+        raise FSError('File "' + name + '" does not exist!')
+      with self.descriptor_lock(fd_index).writing():
+        return self.destroy_entry(name, fd_index)
+
+  def destroy_entry(self, name, fd_index):
+    # Remove from OFT table if file is open
+    for i in sorted(self.OFT):
+      if i > 0 and self.OFT[i][2] == fd_index:
+        self.close_entry(i)
+
+    # Remove directory entry
+    self.remove_directory_entry(name)
+
+    # Clear the file's blocks before handing them back in the bit map
+    blocks = self.file_blocks(fd_index)
+    for disk_block_num in blocks:
+      self.cache.write_block(disk_block_num, EMPTY_BYTE * self.geometry.block_size)
+    self.free_blocks(blocks)
+
+    # Free file descriptor
+    block_num, index = self.descriptor_position(fd_index)
+    for i in range(NUM_INTS_IN_DESCRIPTOR):
+      self.cache.write_int(block_num, index+i, -1)
+    heapq.heappush(self.free_descriptors, fd_index)
+
+    return name + ' destroyed'
 
   def open_file(self, name):
+    with self.lock:
+      return self.open_entry(name)
+
+  def open_entry(self, name):
     # Search directory to find file descriptor
     fd_index = self.retrieve_file(name)
     if fd_index < 0:
@@ -211,217 +876,249 @@ class FileSystem(object):
       oft_index = self.get_OFT_free_entry()
 
       # Fill in file descriptor index and current position
-      self.OFT[oft_index] = [None, 0, fd_index, name]
-
-      # Read block 0 of file into buffer
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+1]
-
-      # Allocate block
-      if disk_block_num == -1:
-        disk_block_num = self.find_empty_block()
-        block_data[index*NUM_DESCRIPTORS_IN_BLOCK+1] = disk_block_num
-        self.current_disk.write_block(block_num, block_data)
-        self.set_bitmap_value(disk_block_num, 1)
-
-      self.OFT[oft_index][0] = self.current_disk.read_block(disk_block_num)
+      self.OFT[oft_index] = [None, 0, fd_index, name, None]
+
+      # Read block 0 of file into buffer, allocating it if need be
+      if self.get_file_block(fd_index, 0) == -1:
+        self.set_file_blocks(fd_index, [0])
+      disk_block_num = self.get_file_block(fd_index, 0)
+
+      self.OFT[oft_index][0] = self.cache.read_block(disk_block_num)
+      self.OFT[oft_index][4] = disk_block_num
       self.open_files.add(name)
       return name + ' opened ' + str(oft_index)
 
   def close_file(self, oft_index):
     oft_index = int(oft_index)
-    if oft_index in self.OFT:
-      rw_buffer, curr_pos, fd_index, name = self.OFT[oft_index]
-
-      # Write buffer to disk
-      disk_offset = curr_pos // NUM_BYTES_IN_BLOCK + 1
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+disk_offset]
-      self.current_disk.write_block(disk_block_num, rw_buffer)
-
-      # Update file length in descriptor
-      file_length = 0
-      for i in range(1, NUM_DESCRIPTORS_IN_BLOCK):
-        tmp_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i]
-        for j in self.current_disk.read_block(tmp_block_num):
-          if j != None:
-            file_length += 1
-          else:
-            break
-      block_data[index*NUM_DESCRIPTORS_IN_BLOCK] = file_length
-      self.current_disk.write_block(block_num, block_data)
-
-      # Free OFT entry
-      del self.OFT[int(oft_index)]
-      self.open_files.discard(name)
-      return str(oft_index) + ' closed'
-    else:
-      raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
+    with self.lock:
+      if oft_index in self.OFT:
+        with self.descriptor_lock(self.OFT[oft_index][2]).writing():
+          return self.close_entry(oft_index)
+      else:
+        raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
+
+  def close_entry(self, oft_index):
+    name = self.OFT[oft_index][3]
+
+    # write_file keeps the descriptor length up to date, so only the
+    # dirty cached blocks need writing back
+    self.cache.flush()
+
+    # Free OFT entry
+    del self.OFT[oft_index]
+    if oft_index > 0:
+      heapq.heappush(self.free_OFT_entries, oft_index)
+    self.open_files.discard(name)
+    return str(oft_index) + ' closed'
 
   def read_file(self, oft_index, count):
     oft_index = int(oft_index)
     count = int(count)
 
-    if oft_index in self.OFT:
-      printed_message = ''
-      rw_buffer, curr_pos, fd_index, name = self.OFT[oft_index]
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      file_length = block_data[index*NUM_DESCRIPTORS_IN_BLOCK]
-      for i in range(curr_pos, curr_pos + count):
-        # Reached end of file
-        curr_pos = i
-        if file_length == i:
-          break
+    with self.locked_entry(oft_index, shared=True) as entry:
+      rw_buffer, curr_pos, fd_index, name, buffer_block = self.entry_state(entry)
+      block_size = self.geometry.block_size
+      file_length = self.cache.read_int(*self.descriptor_position(fd_index))
+
+      # Reading stops at the end of file, and the position is left on the
+      # last byte read unless the end of file was reached
+      if count <= 0:
+        return ''
+      elif curr_pos <= file_length < curr_pos + count:
+        stop = file_length
+        new_pos = file_length
+      else:
+        stop = curr_pos + count
+        new_pos = stop - 1
+
+      # Copy the span out of each block it covers in one slice. Blocks the
+      # file does not have read as empty and leave the buffer alone.
+      chunks = []
+      i = curr_pos
+      while i < stop:
+        n = min(block_size - i % block_size, stop - i)
+        disk_block_num = self.get_file_block(fd_index, i // block_size)
+        if disk_block_num == -1:
+          chunks.append(EMPTY_BYTE * n)
+        else:
+          buffer_block = disk_block_num
+          rw_buffer = self.cache.read_block(buffer_block)
+          chunks.append(rw_buffer[i%block_size:i%block_size+n].tobytes())
+        i += n
+
+      self.set_entry_state(entry, [rw_buffer, new_pos, fd_index, name, buffer_block])
+      return ''.join(chunks)
+
+  def prefix_growth(self, disk_block_num, prefix, start, end):
+    # Bytes start to end of the block were just written over a block whose
+    # written prefix was prefix long. The prefix only grows if the write
+    # touched its end, and then it runs on through any bytes already there.
+    if start <= prefix < end:
+      return self.cache.data_length(disk_block_num, end) - prefix
+    return 0
 
-        disk_offset = i // NUM_BYTES_IN_BLOCK + 1
-        disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+disk_offset]
-        rw_buffer = self.current_disk.read_block(disk_block_num)
-        printed_message += rw_buffer[i%NUM_BYTES_IN_BLOCK]
-      
-      self.OFT[oft_index][0] = rw_buffer
-      self.OFT[oft_index][1] = curr_pos
-      return printed_message
-    else:
-      raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
-    
   def write_file(self, oft_index, char, count):
-    oft_index = int(oft_index)
-    count = int(count)
-
-    if oft_index in self.OFT:
-      rw_buffer, curr_pos, fd_index, name = self.OFT[oft_index]
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      curr_disk_offset = curr_pos // NUM_BYTES_IN_BLOCK + 1
+    return self.write_bytes(oft_index, char * int(count))
 
+  def write_bytes(self, oft_index, data):
+    # Unwritten bytes are stored as EMPTY_BYTE and file lengths are found
+    # from where they start, so data cannot contain it
+    oft_index = int(oft_index)
+    if EMPTY_BYTE in data:
+      raise FSError('Data to write contains an empty byte!')
+    count = len(data)
+
+    with self.locked_entry(oft_index, shared=False) as entry:
+      rw_buffer, curr_pos, fd_index, name, buffer_block = entry
+      block_size = self.geometry.block_size
+      max_file_size = self.geometry.max_file_size
+      block_num, index = self.descriptor_position(fd_index)
+      file_length = self.cache.read_int(block_num, index)
+
+      # Allocate every block the write will move into in one go. Filling a
+      # block up moves the buffer on to the next one, except for the last.
+      end = min(curr_pos + count, max_file_size - 1)
+      missing = [file_block for file_block in range(curr_pos // block_size + 1, end // block_size + 1)
+                 if self.get_file_block(fd_index, file_block) == -1]
+      if missing:
+        self.set_file_blocks(fd_index, missing)
+
+      # Exceed the largest file
+      data = data[:max(0, max_file_size - curr_pos)]
+
+      # Copy the data into the buffer one block-sized span at a time. The
+      # file length is the sum of each block's written prefix, so keep it up
+      # to date from the prefix of every block the write lands in.
       actual_bytes_written = 0
-      for i in range(curr_pos, curr_pos + count):
-        # Exceed 3 disk blocks
-        if i > 3 * NUM_BYTES_IN_BLOCK - 1:
-          break
-
-        rw_buffer[i%NUM_BYTES_IN_BLOCK] = char
-        actual_bytes_written += 1;
+      while actual_bytes_written < len(data):
+        i = curr_pos + actual_bytes_written
+        start = i % block_size
+        n = min(block_size - start, len(data) - actual_bytes_written)
+        prefix = self.cache.data_length(buffer_block)
+        self.cache.write_span(buffer_block, start, data[actual_bytes_written:actual_bytes_written+n])
+        file_length += self.prefix_growth(buffer_block, prefix, start, start + n)
+        actual_bytes_written += n
 
         # End of buffer reached
-        if ((i+1) % NUM_BYTES_IN_BLOCK) == 0 and i != 3 * NUM_BYTES_IN_BLOCK - 1:
-          self.current_disk.write_block(block_num, rw_buffer)
-          prev_disk_offset = curr_disk_offset
-          curr_disk_offset = (i+1) // NUM_BYTES_IN_BLOCK + 1
-          
-          # Write the buffer to disk block
-          prev_disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+prev_disk_offset]
-          self.current_disk.write_block(prev_disk_block_num, rw_buffer)
-          next_disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+curr_disk_offset]
-
-          # If block does not exist yet
-          if next_disk_block_num == -1:
-            # Allocate new block (search and update bitmap)
-            next_disk_block_num = self.find_empty_block()
-            self.set_bitmap_value(next_disk_block_num, 1)
-            # Update file descriptor with new block number
-            block_data[index*NUM_DESCRIPTORS_IN_BLOCK+curr_disk_offset] = next_disk_block_num
-            self.current_disk.write_block(block_num, block_data)
-
-          rw_buffer = self.current_disk.read_block(next_disk_block_num)
+        i += n
+        if i % block_size == 0 and i != max_file_size:
+          # The buffer is a view onto its cached block, so moving on to the
+          # next block needs no write back
+          buffer_block = self.get_file_block(fd_index, i // block_size)
+          rw_buffer = self.cache.read_block(buffer_block)
 
       curr_pos += actual_bytes_written
-      self.OFT[oft_index][0] = rw_buffer
-      self.OFT[oft_index][1] = curr_pos
-      # Update file length in descriptor
-      file_length = 0
-      for i in range(1, NUM_DESCRIPTORS_IN_BLOCK):
-        tmp_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+i]
-        if tmp_block_num != -1:
-          for j in self.current_disk.read_block(tmp_block_num):
-            if j != None:
-              file_length += 1
-            else:
-              break
-      block_data[index*NUM_DESCRIPTORS_IN_BLOCK] = file_length
-      self.current_disk.write_block(block_num, block_data)
+      entry[0] = rw_buffer
+      entry[1] = curr_pos
+      entry[4] = buffer_block
+      self.cache.write_int(block_num, index, file_length)
 
       return str(actual_bytes_written) + ' bytes written'
-    else:
-      raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
 
   def seek_file(self, oft_index, pos):
     oft_index = int(oft_index)
     pos = int(pos)
 
-    if oft_index in self.OFT:
-      rw_buffer, curr_pos, fd_index, name = self.OFT[oft_index]
-      block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-      index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-      block_data = self.current_disk.read_block(block_num)
-      file_length = block_data[index*NUM_DESCRIPTORS_IN_BLOCK]
+    with self.locked_entry(oft_index, shared=True) as entry:
+      rw_buffer, curr_pos, fd_index, name, buffer_block = self.entry_state(entry)
+      block_size = self.geometry.block_size
+      file_length = self.cache.read_int(*self.descriptor_position(fd_index))
 
       # Set seeked position to file length if exceed file length
       if pos > file_length:
         pos = file_length
 
-      current_block = curr_pos // NUM_BYTES_IN_BLOCK
-      seeked_block = pos // NUM_BYTES_IN_BLOCK
+      current_block = curr_pos // block_size
+      seeked_block = pos // block_size
 
-      if current_block != seeked_block:
-        # Read block 0 of file into buffer
-        block_num = fd_index // NUM_DESCRIPTORS_IN_BLOCK + 1
-        index = fd_index % NUM_DESCRIPTORS_IN_BLOCK
-        block_data = self.current_disk.read_block(block_num)
-        disk_block_num = block_data[index*NUM_DESCRIPTORS_IN_BLOCK+1+seeked_block]
-        self.OFT[oft_index][0] = self.current_disk.read_block(disk_block_num)
+      # A position just past the last block keeps the current buffer
+      if current_block != seeked_block and seeked_block < self.geometry.max_file_blocks:
+        # Read block of file into buffer
+        disk_block_num = self.get_file_block(fd_index, seeked_block)
+        if disk_block_num != -1:
+          rw_buffer = self.cache.read_block(disk_block_num)
+          buffer_block = disk_block_num
 
       # Set the current position to the new position
-      self.OFT[oft_index][1] = pos
+      self.set_entry_state(entry, [rw_buffer, pos, fd_index, name, buffer_block])
       return 'position is ' + str(pos)
-    else:
-      raise FSError('Index "' + str(oft_index) + '" does not exist in OFT!')
 
   def list_dir_files(self):
-    file_names = []
-    for block_num in range(7, 10):
-      block_data = self.current_disk.read_block(block_num)
-      for i in range(len(block_data)/2):
-        if block_data[i*2] != -1:
-          file_names.append(convert_int_to_filename(block_data[i*2]))
-    return ' '.join(file_names)
-
-  def init_disk(self, name=''):
-    self.OFT = {0: [0, 0, 0, None]}
-    self.open_files = set()
+    # Listed in directory slot order
+    with self.lock:
+      entries = sorted((slot, num) for num, (fd_index, slot) in self.directory.items())
+    return ' '.join(convert_int_to_filename(num) for slot, num in entries)
+
+  def init_disk(self, name='', *geometry):
+    # A new disk takes its geometry from any arguments after the name: the
+    # number of blocks, block size, descriptor blocks, directory blocks and
+    # 1 for indirect blocks. A restored disk takes it from its superblock.
+    geometry = Geometry(*geometry)
+    with self.lock:
+      return self.load_disk(name, geometry)
+
+  def load_disk(self, name, geometry):
+    self.reset_OFT({0: [0, 0, 0, None, None]})
+    self.descriptor_locks = {}
     try:
       if name != '':
-        with open(DISK_DIR + name, 'r') as f:
-          self.current_disk = Disk(name, pickle.loads(f.read()))
-          return 'disk restored' 
+        path = DISK_DIR + name
+        image, raw = load_image(path)
+        self.current_disk = Disk(name, image, path=path if raw else None)
+        message = 'disk restored'
       else:
         raise IOError
     except IOError:
-      self.current_disk = Disk(name, [])
-      return 'disk initialized'
+      self.current_disk = Disk(name, geometry=geometry)
+      message = 'disk initialized'
+    self.geometry = self.current_disk.geometry
+    self.cache = BlockCache(self.current_disk, self.cache_blocks)
+    self.build_directory_index()
+    return message
 
   def save_disk(self, name):
-    if not self.current_disk:
-      raise FSError('No disk has been initialized!')
-    else:
-      self.OFT = {}
-      self.open_files = set()
-      self.current_disk.save_disk(name)
-      return 'disk saved'
+    with self.lock:
+      if not self.current_disk:
+        raise FSError('No disk has been initialized!')
+      else:
+        self.reset_OFT({})
+        self.cache.save_disk(name)
+        return 'disk saved'
 
 
-def main():
+def benchmark(size, block_size, chunk_size):
+  # Sequential writes of one file on a fresh indexed disk just big enough
+  # to hold it, in chunk_size writes, including the flush on close
+  data_blocks = (size + block_size - 1) // block_size
+  used_blocks = (data_blocks + data_blocks // (block_size // NUM_BYTES_IN_INT) + 3 +
+                 NUM_DESCRIPTOR_BLOCKS + NUM_DIRECTORY_BLOCKS)
+  num_blocks = used_blocks + used_blocks // (block_size * NUM_BITS_IN_BYTE) + 2
 
   fs = FileSystem()
-
-  commands_mapping = {
+  fs.init_disk('', num_blocks, block_size, NUM_DESCRIPTOR_BLOCKS, NUM_DIRECTORY_BLOCKS, 1)
+  fs.create_file('big')
+  oft_index = int(fs.open_file('big').split()[-1])
+  chunk = 'x' * chunk_size
+
+  written = 0
+  start = timeit.default_timer()
+  while written < size:
+    result = fs.write_bytes(oft_index, chunk[:size - written])
+    written += int(result.split()[0])
+    if result.startswith('0 '):
+      break
+  fs.close_file(oft_index)
+  elapsed = timeit.default_timer() - start
+
+  stats = fs.cache.stats()
+  rate = written / elapsed / (1 << 20) if elapsed > 0 else float('inf')
+  print '{0:>12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+      'bytes', 'seconds', 'MB/s', 'hits', 'misses', 'flushes')
+  print '{0:>12} {1:>10.3f} {2:>10.2f} {3:>10} {4:>10} {5:>10}'.format(
+      written, elapsed, rate, stats['hits'], stats['misses'], stats['flushes'])
+
+def commands_mapping(fs):
+  return {
     'cr': fs.create_file,
     'de': fs.destroy_file,
     'op': fs.open_file,
@@ -434,16 +1131,337 @@ def main():
     'sv': fs.save_disk
   }
 
+def parse_command(commands, line):
+  # (name, handler, args) for a line of the driver language, with no
+  # handler for an unknown command, or None for a blank line
+  cmd = [p.strip() for p in line.split(' ') if p.strip() != '']
+  if not cmd:
+    return None
+  return cmd[0], commands.get(cmd[0]), cmd[1:]
+
+def parse_script(commands, lines):
+  return [parse_command(commands, line.rstrip('\n')) for line in lines]
+
+def run_op(op):
+  if op is None:
+    return ''
+  name, handler, args = op
+  if handler is None:
+    raise FSError('Invalid command!')
+  return handler(*args)
+
+def run_command(commands, line):
+  return run_op(parse_command(commands, line))
+
+def run_script(ops, output):
+  # Results are collected in output rather than returned so those before
+  # a crash can still be written out
+  for op in ops:
+    try:
+      output.append(str(run_op(op)))
+    except FSError as e:
+      output.append(e.value if DEBUG else 'error')
+
+def batch(path):
+  fs = FileSystem()
+  with open(path) as f:
+    ops = parse_script(commands_mapping(fs), f)
+
+  output = []
+  try:
+    run_script(ops, output)
+  finally:
+    sys.stdout.write(''.join(line + '\n' for line in output))
+
+def input_scripts():
+  input_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input')
+  return sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir)
+                if f.endswith('.txt'))
+
+@contextlib.contextmanager
+def scratch_directory():
+  # Runs in a temporary directory with its own disk directory, which is
+  # removed afterwards
+  cwd = os.getcwd()
+  scratch = tempfile.mkdtemp()
+  try:
+    os.chdir(scratch)
+    os.mkdir(DISK_DIR)
+    yield
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(scratch)
+
+def counted_length(fs, fd_index):
+  # File length by the rule write_file used before keeping it up to date:
+  # the written prefix of every data block of the file, a byte at a time
+  length = 0
+  for file_block in range(fs.geometry.max_file_blocks):
+    disk_block_num = fs.get_file_block(fd_index, file_block)
+    if disk_block_num != -1:
+      for byte in fs.cache.read_block(disk_block_num).tobytes():
+        if byte == EMPTY_BYTE:
+          break
+        length += 1
+  return length
+
+def check_lengths(paths):
+  # Runs each script and after every command compares the stored length
+  # of every file with the counted one
+  paths = [os.path.abspath(path) for path in paths]
+  failures = []
+  with scratch_directory():
+    for path in paths:
+      fs = FileSystem()
+      with open(path) as f:
+        ops = parse_script(commands_mapping(fs), f)
+      for line_num, op in enumerate(ops, 1):
+        try:
+          run_op(op)
+        except FSError:
+          pass
+        if not fs.current_disk:
+          continue
+        for num, (fd_index, slot) in sorted(fs.directory.items()):
+          stored = fs.cache.read_int(*fs.descriptor_position(fd_index))
+          counted = counted_length(fs, fd_index)
+          if stored != counted:
+            failures.append('{0}:{1}: {2} has length {3}, counted {4}'.format(
+                path, line_num, convert_int_to_filename(num), stored, counted))
+      print os.path.basename(path) + ':', len(ops), 'commands checked'
+  return failures
+
+def replay(paths, times):
+  # Runs the scripts one after another, times over, timing every command.
+  # Disks are saved to and restored from a scratch directory.
+  fs = FileSystem()
+  commands = commands_mapping(fs)
+  ops = []
+  for path in paths:
+    with open(path) as f:
+      ops.extend(parse_script(commands, f))
+  ops = [op for op in ops if op is not None and op[1] is not None] * times
+
+  timings = {}
+  counts = {}
+  with scratch_directory():
+    for name, handler, args in ops:
+      start = timeit.default_timer()
+      try:
+        handler(*args)
+      except FSError:
+        pass
+      timings[name] = timings.get(name, 0) + timeit.default_timer() - start
+      counts[name] = counts.get(name, 0) + 1
+
+  print '{0:>8} {1:>10} {2:>10} {3:>12}'.format('command', 'ops', 'seconds', 'ops/s')
+  rows = sorted(counts) + ['all']
+  counts['all'] = len(ops)
+  timings['all'] = sum(timings.values())
+  for name in rows:
+    rate = counts[name] / timings[name] if timings[name] > 0 else float('inf')
+    print '{0:>8} {1:>10} {2:>10.3f} {3:>12.0f}'.format(name, counts[name], timings[name], rate)
+
+class DriverHandler(SocketServer.StreamRequestHandler):
+  # One line of output per line of commands, as the stdin driver prints.
+  # Any failure, including malformed arguments, is reported and the
+  # connection kept open.
+  def handle(self):
+    for line in self.rfile:
+      try:
+        result = run_command(self.server.commands, line.rstrip('\n'))
+      except FSError as e:
+        result = e.value if DEBUG else 'error'
+      except Exception:
+        result = 'error'
+      self.wfile.write(result + '\n')
+      self.wfile.flush()
+
+def serve(path, disk_name):
+  # Clients share one disk, which only the server may initialize or swap.
+  # The OFT grows with the number of files open. Clients share the OFT
+  # too, and saving a disk closes every file in it, so neither 'in' nor
+  # 'sv' is served; either would close the other clients' files.
+  fs = FileSystem(max_open_files=None)
+  fs.init_disk(disk_name or '')
+  commands = commands_mapping(fs)
+  del commands['in']
+  del commands['sv']
+
+  if os.path.exists(path):
+    os.unlink(path)
+  server = SocketServer.ThreadingUnixStreamServer(path, DriverHandler)
+  server.daemon_threads = True
+  server.commands = commands
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.unlink(path)
+
+def load_test(path, client_counts, ops):
+  # Each client creates and opens a file of its own, then cycles through
+  # write, seek and read requests on it
+  def client(num, timings):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+
+    def request(line):
+      wfile.write(line + '\n')
+      wfile.flush()
+      return rfile.readline()
+
+    name = 'l' + str(num)
+    request('de ' + name)
+    request('cr ' + name)
+    oft_index = request('op ' + name).split()[-1]
+    cycle = ['wr ' + oft_index + ' x 16', 'sk ' + oft_index + ' 0',
+             'rd ' + oft_index + ' 16']
+    start = timeit.default_timer()
+    for i in range(ops):
+      request(cycle[i % len(cycle)])
+    timings[num] = timeit.default_timer() - start
+    request('cl ' + oft_index)
+    sock.close()
+
+  print '{0:>8} {1:>10} {2:>10} {3:>10}'.format('clients', 'ops', 'seconds', 'ops/s')
+  for count in client_counts:
+    timings = {}
+    threads = [threading.Thread(target=client, args=(num, timings))
+               for num in range(count)]
+    start = timeit.default_timer()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = timeit.default_timer() - start
+    total = ops * len(timings)
+    rate = total / elapsed if elapsed > 0 else float('inf')
+    print '{0:>8} {1:>10} {2:>10.3f} {3:>10.0f}'.format(count, total, elapsed, rate)
+
+def stress(seconds, readers=3):
+  # Readers seek and read one file while another thread keeps destroying,
+  # recreating and writing it, which takes the locks from both ends. Any
+  # thread still running once asked to stop is taken as deadlocked.
+  fs = FileSystem()
+  fs.init_disk()
+  fs.create_file('s')
+  fs.open_file('s')
+  fs.write_file(1, 'x', 10)
+  stop = threading.Event()
+  counts = [0] * (readers + 1)
+
+  def reader(num):
+    while not stop.is_set():
+      try:
+        fs.seek_file(1, 0)
+        fs.read_file(1, 10)
+      except FSError:
+        pass
+      counts[num] += 1
+
+  def mutator():
+    while not stop.is_set():
+      try:
+        fs.destroy_file('s')
+        fs.create_file('s')
+        oft_index = fs.open_file('s').split()[-1]
+        fs.write_file(oft_index, 'y', 10)
+      except FSError:
+        pass
+      counts[readers] += 1
+
+  threads = [threading.Thread(target=reader, args=(num,)) for num in range(readers)]
+  threads.append(threading.Thread(target=mutator))
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  stop.wait(seconds)
+  stop.set()
+  for thread in threads:
+    thread.join(5)
+
+  failures = []
+  for num, thread in enumerate(threads):
+    if thread.is_alive():
+      failures.append('thread ' + str(num) + ' deadlocked after ' +
+                      str(counts[num]) + ' rounds')
+  print 'rounds per thread:', ' '.join(str(count) for count in counts)
+  return failures
+
+def main():
+  parser = argparse.ArgumentParser(description='File system driver reading '
+                                               'commands from stdin')
+  parser.add_argument('script', nargs='*',
+                      help='run a script of commands in one batch instead of '
+                           'reading stdin')
+  parser.add_argument('--bench', type=int, metavar='KB',
+                      help='time sequential writes of a KB kilobyte file on '
+                           'an indexed disk and exit')
+  parser.add_argument('--block-size', type=int, default=1024,
+                      help='block size for --bench (default: %(default)s)')
+  parser.add_argument('--chunk', type=int, default=4096,
+                      help='bytes per write for --bench (default: %(default)s)')
+  parser.add_argument('--serve', metavar='SOCKET',
+                      help='serve driver commands to clients connecting to a '
+                           'Unix socket instead of reading stdin')
+  parser.add_argument('--disk', metavar='NAME',
+                      help='disk image for --serve to restore (default: a '
+                           'new disk)')
+  parser.add_argument('--load', metavar='SOCKET',
+                      help='load test a server on a Unix socket and exit')
+  parser.add_argument('--clients', default='1,2,4,8',
+                      help='comma separated client counts for --load '
+                           '(default: %(default)s)')
+  parser.add_argument('--ops', type=int, default=3000,
+                      help='requests per client for --load (default: %(default)s)')
+  parser.add_argument('--stress', type=float, metavar='SECONDS',
+                      help='run threads contending for one file for SECONDS '
+                           'and fail if any of them deadlock')
+  parser.add_argument('--check-lengths', action='store_true',
+                      help='check stored file lengths against counted ones '
+                           'after every command of the scripts, or of every '
+                           'script in the input directory, and exit')
+  parser.add_argument('--replay', type=int, metavar='N',
+                      help='time each command type over N runs of the scripts, '
+                           'or of every script in the input directory, and exit')
+  args = parser.parse_args()
+
+  if args.bench:
+    benchmark(args.bench * 1024, args.block_size, args.chunk)
+    return
+  elif args.serve:
+    serve(args.serve, args.disk)
+    return
+  elif args.load:
+    load_test(args.load, [int(c) for c in args.clients.split(',')], args.ops)
+    return
+  elif args.stress:
+    failures = stress(args.stress)
+    for failure in failures:
+      print 'FAIL', failure
+    sys.exit(1 if failures else 0)
+  elif args.check_lengths:
+    failures = check_lengths(args.script or input_scripts())
+    for failure in failures:
+      print 'FAIL', failure
+    sys.exit(1 if failures else 0)
+  elif args.replay:
+    replay(args.script or input_scripts(), args.replay)
+    return
+  elif args.script:
+    for path in args.script:
+      batch(path)
+    return
+
+  fs = FileSystem()
+  commands = commands_mapping(fs)
+
   while True:
     try:
-      cmd = [p.strip() for p in raw_input().split(' ') if p.strip() != '']
-      if cmd:
-        if cmd[0] in commands_mapping:
-          print commands_mapping[cmd[0]](*cmd[1:])
-        else:
-          raise FSError('Invalid command!')
-      else:
-        print ''
+      print run_command(commands, raw_input())
     except FSError as e:
       print e.value if DEBUG else 'error'
     except EOFError: